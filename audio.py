@@ -0,0 +1,767 @@
+import collections
+import math
+import numpy
+import threading
+import time
+
+try:
+    import pyaudio
+except ImportError:
+    # Only needed for live capture; offline analysis runs without it
+    pyaudio = None
+
+# Optional faster FFT implementations
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+    pyfftw.interfaces.cache.enable()
+except ImportError:
+    pyfftw = None
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+def fbin(freq, chunk, rate):
+    # Index of the FFT bin containing `freq`
+    return int(chunk * freq / float(rate))
+
+def bin_freq(b, chunk, rate):
+    # Center frequency of FFT bin `b`
+    return rate * float(b) / chunk
+
+def decode_samples(data, dtype=numpy.int16):
+    # View a raw PCM buffer as an array of samples, without copying
+    return numpy.frombuffer(data, dtype=dtype)
+
+WINDOWS = {
+    "rect": numpy.ones,
+    "hann": numpy.hanning,
+    "hamming": numpy.hamming,
+    "blackman": numpy.blackman,
+}
+_window_cache = {}
+_fastest_backend = {}
+
+def fft_window(name, size):
+    # Window coefficients, computed once per (name, size)
+    key = (name, size)
+    if key not in _window_cache:
+        _window_cache[key] = WINDOWS[name](size)
+    return _window_cache[key]
+
+def fft_backends():
+    # Available rfft implementations, preferred first
+    backends = []
+    if pyfftw is not None:
+        backends.append(("pyfftw", pyfftw.interfaces.numpy_fft.rfft))
+    if scipy_fft is not None:
+        backends.append(("scipy", scipy_fft.rfft))
+    backends.append(("numpy", numpy.fft.rfft))
+    return collections.OrderedDict(backends)
+
+def fastest_fft_backend(size, trials=20):
+    # Time each available backend once per FFT size and remember the winner
+    if size not in _fastest_backend:
+        x = numpy.random.randn(size)
+        timings = []
+        for name in fft_backends():
+            # The whole PowerSpectrum path, so every backend pays for its
+            # own copies and buffer handling
+            fn = PowerSpectrum(size, backend=name)
+            fn(x)
+            start = time.time()
+            for i in range(trials):
+                fn(x)
+            timings.append((time.time() - start, name))
+        _fastest_backend[size] = min(timings)[1]
+    return _fastest_backend[size]
+
+class PowerSpectrum(object):
+    """
+    Windowed rfft power spectrum of fixed-size frames.
+
+    Input, output and power buffers are allocated once. With pyfftw the
+    transform runs through a plan built for those buffers (FFTW wisdom
+    makes re-planning the same size cheap), so a frame allocates nothing;
+    numpy and scipy still allocate their complex result.
+
+    `backend` is "pyfftw", "scipy", "numpy", or "auto" to time the
+    available ones and use the fastest. The returned power array is reused,
+    so it is only valid until the next call.
+    """
+    def __init__(self, size, window="rect", backend="auto"):
+        self.size = size
+        self.window = fft_window(window, size)
+        backends = fft_backends()
+        if backend == "auto":
+            backend = fastest_fft_backend(size)
+        elif backend not in backends:
+            backend = list(backends)[0]
+        self.backend = backend
+        self.rfft = backends[backend]
+
+        if backend == "pyfftw":
+            self.input = pyfftw.empty_aligned(size, dtype="float64")
+            self.output = pyfftw.empty_aligned(size // 2 + 1, dtype="complex128")
+            self.plan = pyfftw.FFTW(self.input, self.output, flags=("FFTW_MEASURE",))
+        else:
+            self.input = numpy.zeros(size)
+            self.output = None
+            self.plan = None
+        self.power = numpy.zeros(size // 2 + 1)
+
+    def __call__(self, samples):
+        numpy.multiply(samples, self.window, out=self.input)
+        if self.plan is not None:
+            self.plan()
+            fft = self.output
+        else:
+            fft = self.rfft(self.input)
+        numpy.absolute(fft, out=self.power)
+        numpy.square(self.power, out=self.power)
+        return self.power
+
+    def batch(self, frames):
+        # Power spectra of many frames at once (one row per frame)
+        fft = self.rfft(frames * self.window, axis=1)
+        power = numpy.absolute(fft)
+        numpy.square(power, out=power)
+        return power
+
+class BandAnalyzer(object):
+    """
+    Sums FFT power over a set of frequency bands.
+
+    Bin edges are computed once; each frame is a single cumulative sum
+    followed by one gather, so the cost barely depends on the number of bands.
+    """
+    def __init__(self, ranges, chunk, rate):
+        self.ranges = list(ranges)
+        self.chunk = chunk
+        self.rate = rate
+        n_bins = chunk // 2 + 1
+        edges = [(fbin(low, chunk, rate), fbin(high, chunk, rate)) for low, high in self.ranges]
+        edges = numpy.clip(numpy.array(edges, dtype=numpy.intp).reshape(-1, 2), 0, n_bins)
+        self.low = edges[:, 0]
+        self.high = numpy.maximum(edges[:, 1], self.low)
+        self.csum = numpy.zeros(n_bins + 1)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def energies(self, fft):
+        numpy.cumsum(fft, out=self.csum[1:len(fft) + 1])
+        return self.csum[self.high] - self.csum[self.low]
+
+    def energies_batch(self, ffts):
+        # One row of band energies per row of `ffts`
+        csum = numpy.zeros((len(ffts), ffts.shape[1] + 1))
+        numpy.cumsum(ffts, axis=1, out=csum[:, 1:])
+        return csum[:, self.high] - csum[:, self.low]
+
+class RingBuffer(object):
+    """
+    Fixed-size sample buffer addressed by absolute sample position.
+
+    `written` counts every sample ever written, so readers can ask for any
+    window that has not yet been overwritten.
+    """
+    def __init__(self, size, dtype=numpy.int16):
+        self.size = size
+        self.data = numpy.zeros(size, dtype=dtype)
+        self.written = 0
+
+    def write(self, samples):
+        n = len(samples)
+        if n > self.size:
+            self.written += n - self.size
+            samples = samples[-self.size:]
+            n = self.size
+        i = self.written % self.size
+        first = min(n, self.size - i)
+        self.data[i:i + first] = samples[:first]
+        self.data[:n - first] = samples[first:]
+        self.written += n
+
+    def read(self, start, out):
+        # Copy the samples [start, start + len(out)) into `out`
+        n = len(out)
+        if start < self.written - self.size or start + n > self.written:
+            raise IndexError("window not in buffer")
+        i = start % self.size
+        first = min(n, self.size - i)
+        out[:first] = self.data[i:i + first]
+        out[first:] = self.data[:n - first]
+        return out
+
+class CallbackCapture(object):
+    """
+    Non-blocking PyAudio input feeding a ring buffer.
+
+    `read()` returns overlapping windows of `chunk` samples, advancing by
+    `hop` samples each call. If analysis falls behind it skips ahead to the
+    newest complete window instead of working through a backlog.
+    `window_time` is when the last sample of the window was captured.
+    """
+    def __init__(self, pa, chunk, hop, rate, channels=1, format=None, capacity=None):
+        self.chunk = chunk
+        self.hop = hop
+        self.rate = rate
+        self.ring = RingBuffer(capacity or 8 * chunk)
+        self.window = numpy.zeros(chunk, dtype=self.ring.data.dtype)
+        self.next_end = chunk
+        self.skipped = 0
+        # Hops skipped by the last read()
+        self.last_skipped = 0
+        # Capture time of the newest sample in the ring
+        self.written_time = None
+        self.window_time = None
+        self.cond = threading.Condition()
+        self.stream = pa.open(
+            format=format or pyaudio.paInt16,
+            channels=channels,
+            rate=rate,
+            input=True,
+            frames_per_buffer=hop,
+            stream_callback=self._callback)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        samples = decode_samples(in_data)
+        now = time.time()
+        end_time = now
+        if time_info and time_info.get("input_buffer_adc_time"):
+            # PortAudio's stream clock: how long ago the buffer started
+            lag = time_info["current_time"] - time_info["input_buffer_adc_time"]
+            end_time = now - lag + frame_count / float(self.rate)
+        with self.cond:
+            self.ring.write(samples)
+            self.written_time = min(end_time, now)
+            self.cond.notify()
+        return (None, pyaudio.paContinue)
+
+    def read(self, timeout=1.0):
+        with self.cond:
+            while self.ring.written < self.next_end:
+                self.cond.wait(timeout)
+                if self.ring.written < self.next_end and not self.stream.is_active():
+                    raise IOError("audio stream stopped")
+            behind = (self.ring.written - self.next_end) // self.hop
+            self.last_skipped = behind
+            if behind:
+                self.skipped += behind
+                self.next_end += behind * self.hop
+            self.ring.read(self.next_end - self.chunk, self.window)
+            self.window_time = self.written_time - (self.ring.written - self.next_end) / float(self.rate)
+        self.next_end += self.hop
+        return self.window
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+
+class ChromaAnalyzer(object):
+    """
+    Dominant-frequency hue and 12-bin chroma from an FFT power spectrum.
+
+    For every octave above `min_freq` the loudest bin gives a position
+    within the octave; the hue is the amplitude-weighted average of those
+    positions. The chroma vector sums power per pitch class (C=0 .. B=11).
+    All bin maps are built once, so a frame is a few gathers and reductions.
+    """
+    def __init__(self, chunk, rate, min_freq=200, octaves=12):
+        self.chunk = chunk
+        self.rate = rate
+
+        ranges = []
+        for o in range(octaves):
+            if (2 ** o) < min_freq:
+                continue
+            o_low = fbin(2 ** o, chunk, rate)
+            o_high = fbin(2 ** (o + 1), chunk, rate) - 1
+            if o_low <= 1 or o_high <= o_low:
+                continue
+            ranges.append((o_low, o_high))
+
+        # Octaves have different widths; pad rows with a sentinel bin that is
+        # masked out before the argmax
+        width = max(high - low for low, high in ranges)
+        self.octave_bins = numpy.zeros((len(ranges), width), dtype=numpy.intp)
+        self.octave_mask = numpy.zeros((len(ranges), width), dtype=bool)
+        for i, (low, high) in enumerate(ranges):
+            self.octave_bins[i, :high - low] = numpy.arange(low, high)
+            self.octave_mask[i, :high - low] = True
+        self.rows = numpy.arange(len(ranges))
+
+        n_bins = chunk // 2 + 1
+        freqs = numpy.arange(n_bins) * rate / float(chunk)
+        freqs[0] = freqs[1]
+        octave = 2.0 ** numpy.floor(numpy.log2(freqs))
+        self.bin_pos = (freqs - octave) / octave
+
+        self.chroma_bins = numpy.arange(ranges[0][0], ranges[-1][1])
+        midi = 69 + 12 * numpy.log2(freqs[self.chroma_bins] / 440.0)
+        self.chroma_class = numpy.round(midi).astype(numpy.intp) % 12
+        self.chroma = numpy.zeros(12)
+
+    def analyze(self, fft):
+        # Returns (hue, chroma)
+        samples = numpy.where(self.octave_mask, fft[self.octave_bins], -1.0)
+        peaks = samples.argmax(axis=1)
+        amps = samples[self.rows, peaks]
+        pos = self.bin_pos[self.octave_bins[self.rows, peaks]]
+        weight = amps.sum()
+        hue = float(numpy.dot(pos, amps) / weight) if weight > 0 else 0.0
+
+        chroma = numpy.bincount(self.chroma_class, weights=fft[self.chroma_bins], minlength=12)
+        top = chroma.max()
+        if top > 0:
+            chroma /= top
+        self.chroma = chroma
+        return hue, chroma
+
+    def analyze_batch(self, ffts):
+        # Returns (hues, chromas) with one row per row of `ffts`
+        samples = numpy.where(self.octave_mask, ffts[:, self.octave_bins], -1.0)
+        peaks = samples.argmax(axis=2)
+        frames = numpy.arange(len(ffts))[:, None]
+        amps = samples[frames, self.rows[None, :], peaks]
+        pos = self.bin_pos[self.octave_bins[self.rows[None, :], peaks]]
+        weight = amps.sum(axis=1)
+        hues = numpy.where(weight > 0, (pos * amps).sum(axis=1) / numpy.where(weight > 0, weight, 1.0), 0.0)
+
+        chromas = numpy.zeros((len(ffts), 12))
+        for pc in range(12):
+            chromas[:, pc] = ffts[:, self.chroma_bins[self.chroma_class == pc]].sum(axis=1)
+        top = chromas.max(axis=1, keepdims=True)
+        chromas /= numpy.where(top > 0, top, 1.0)
+        return hues, chromas
+
+class SpectrumPublisher(object):
+    """
+    Decimated log spectrum for the web UI.
+
+    Bins up to `max_freq` are grouped into `n_bins` display bins (max of each
+    group), normalized to [0, 1]. Nothing is computed unless `ui_rate` says
+    it's time to publish again.
+    """
+    def __init__(self, chunk, rate, n_bins=64, max_freq=4000.0, min_bin=20, ui_rate=10.0):
+        self.chunk = chunk
+        self.rate = rate
+        self.min_bin = min_bin
+        self.top = min(fbin(max_freq, chunk, rate), chunk // 2 + 1)
+        self.starts = numpy.unique(numpy.linspace(0, self.top, n_bins + 1).astype(numpy.intp)[:-1])
+        self.freqs = [int(bin_freq(b, chunk, rate)) for b in self.starts]
+        self.period = 1.0 / ui_rate
+        self.last_publish = None
+
+    def due(self, now):
+        return self.last_publish is None or now - self.last_publish >= self.period
+
+    def compute(self, fft):
+        # Returns (display bins, dominant frequency)
+        log = numpy.log1p(fft[:self.top])
+        display = numpy.maximum.reduceat(log, self.starts)
+        mval = log.max()
+        if mval > 0:
+            display /= mval
+        dom_chk = fft[self.min_bin:-self.min_bin].argmax() + self.min_bin
+        return numpy.round(display, 3).tolist(), int(bin_freq(dom_chk, self.chunk, self.rate))
+
+    def update(self, fft, now=None):
+        # Returns None when it's not yet time to publish
+        if now is None:
+            now = time.time()
+        if not self.due(now):
+            return None
+        self.last_publish = now
+        return self.compute(fft)
+
+class LevelNormalizer(object):
+    """
+    Running per-band peak used to scale band energies into [0, 1].
+
+    Each band either takes the max over a sliding window of `window` frames
+    (a monotonic deque, so amortized O(1) per frame regardless of length) or,
+    if its `decay` is below 1.0, a peak that decays by that factor per frame.
+    `window` and `decay` may be scalars or per-band sequences. The last
+    `max(window)` frames are kept in a numpy ring buffer as `history`.
+    """
+    def __init__(self, n_bands, window=200, decay=1.0, floor=1.0):
+        self.n_bands = n_bands
+        self.window = numpy.broadcast_to(numpy.asarray(window, dtype=numpy.intp), (n_bands,)).copy()
+        self.decay = numpy.broadcast_to(numpy.asarray(decay, dtype=float), (n_bands,)).copy()
+        self.decaying = self.decay < 1.0
+        self.windowed = numpy.flatnonzero(~self.decaying)
+        self.floor = floor
+        self.ring = numpy.zeros((int(self.window.max()), n_bands))
+        self.t = 0
+        self.reset(numpy.zeros(n_bands))
+        self.filled = 0
+
+    def reset(self, values=None):
+        # Forget everything but `values` (default: the latest frame), as if
+        # it had filled the whole window
+        if values is None:
+            values = self.ring[(self.t - 1) % len(self.ring)]
+        values = numpy.array(values, dtype=float)
+        self.ring[:] = values
+        self.filled = len(self.ring)
+        self.maxima = [collections.deque([(self.t - 1, v)]) for v in values]
+        self.peak = values.copy()
+        self.scale = numpy.maximum(values, self.floor)
+
+    @property
+    def history(self):
+        # Stored frames, oldest first
+        if self.filled < len(self.ring):
+            return self.ring[:self.filled]
+        return numpy.roll(self.ring, -(self.t % len(self.ring)), axis=0)
+
+    def push(self, values):
+        # Add a frame; returns the per-band scaling factors
+        values = numpy.asarray(values, dtype=float)
+        t = self.t
+        self.ring[t % len(self.ring)] = values
+        self.t += 1
+        self.filled = min(self.filled + 1, len(self.ring))
+
+        for j in self.windowed:
+            v = values[j]
+            dq = self.maxima[j]
+            while dq and dq[-1][1] <= v:
+                dq.pop()
+            dq.append((t, v))
+            while dq[0][0] <= t - self.window[j]:
+                dq.popleft()
+            self.peak[j] = dq[0][1]
+
+        if self.decaying.any():
+            decayed = numpy.maximum(values, self.peak * self.decay)
+            self.peak[self.decaying] = decayed[self.decaying]
+
+        numpy.maximum(self.peak, self.floor, out=self.scale)
+        return self.scale
+
+    def normalize(self, values):
+        return numpy.clip(numpy.asarray(values, dtype=float) / self.scale, 0.0, 1.0)
+
+class FilterBank(object):
+    """
+    A set of named one-pole smoothing filters advanced together.
+
+    Kinds match the scalar filters in beetle.py:
+        "lpf"   -- linear low-pass
+        "diode" -- low-pass with a separate attack coefficient (`dalpha`)
+        "circ"  -- low-pass on a circle of circumference 1.0 (e.g. hue)
+    All state, alphas and kinds live in arrays so one `update()` call
+    advances every channel.
+    """
+    KINDS = {"lpf": 0, "diode": 1, "circ": 2}
+
+    def __init__(self):
+        self.index = {}
+        self.names = []
+        self.kind = numpy.zeros(0, dtype=numpy.intp)
+        self.alpha = numpy.zeros(0)
+        self.dalpha = numpy.zeros(0)
+        self.state = numpy.zeros(0)
+        self.input = numpy.zeros(0)
+        self.kinds_changed()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.state[self.index[name]]
+
+    def add(self, name, kind="lpf", alpha=0.1, dalpha=0.0, value=None):
+        # Register a channel; with no `value` it starts at its first input
+        if name in self.index:
+            raise ValueError("Filter channel {} already exists".format(name))
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.kind = numpy.append(self.kind, self.KINDS[kind])
+        self.alpha = numpy.append(self.alpha, alpha)
+        self.dalpha = numpy.append(self.dalpha, dalpha)
+        self.state = numpy.append(self.state, numpy.nan if value is None else value)
+        self.input = numpy.append(self.input, numpy.nan)
+        self.kinds_changed()
+        return self.index[name]
+
+    def kinds_changed(self):
+        self.diode = self.kind == self.KINDS["diode"]
+        self.circ = self.kind == self.KINDS["circ"]
+        self.any_diode = self.diode.any()
+        self.any_circ = self.circ.any()
+
+    def set_alpha(self, name, alpha, dalpha=None):
+        i = self.index[name]
+        self.alpha[i] = alpha
+        if dalpha is not None:
+            self.dalpha[i] = dalpha
+
+    def reset(self, name=None):
+        if name is None:
+            self.state[:] = numpy.nan
+        else:
+            self.state[self.index[name]] = numpy.nan
+
+    def update(self, data):
+        """
+        Advance the filters and return the state array.
+
+        `data` is either a sequence with one value per channel (in the order
+        channels were added), or a dict of {name: value} which only advances
+        the named channels.
+        """
+        if isinstance(data, dict):
+            self.input[:] = numpy.nan
+            for name, value in data.items():
+                self.input[self.index[name]] = value
+        else:
+            self.input[:] = data
+        active = ~numpy.isnan(self.input)
+        x = self.input
+        mem = numpy.where(numpy.isnan(self.state), x, self.state)
+        alpha = self.alpha
+
+        result = mem + alpha * (x - mem)
+
+        if self.any_diode:
+            attack = self.diode & (x > mem)
+            result[attack] = (x + self.dalpha * (mem - x))[attack]
+
+        if self.any_circ:
+            circ = self.circ
+            a = numpy.minimum(x, mem)
+            b = numpy.maximum(x, mem)
+            direct = a + alpha * (b - a)
+            wrapped = (a + 1.0 + alpha * (b - a - 1.0)) % 1.0
+            take_direct = (numpy.abs(mem - direct) < numpy.abs(mem - wrapped)) ^ (alpha > 0.5)
+            result[circ] = numpy.where(take_direct, direct, wrapped)[circ]
+
+        self.state[active] = result[active]
+        return self.state
+
+class AnalysisChain(object):
+    """
+    Audio features for one frame: band energies, dominant-frequency hue,
+    chroma, low-passed bands, normalized levels and smoothed features.
+
+    This is the analysis half of `Beetle.step`, kept free of PyAudio so the
+    same chain can run offline. `analyze_batch` does the FFT-domain work for
+    many frames at once; the stateful smoothing always runs frame by frame.
+    """
+    CHUNK = 2048
+    RATE = 48000
+    RANGES = [(20,300),(300,1400),(1600,2800),(3000,6000)]
+    MIN_FREQ = 200
+    HISTORY_SIZE = 200
+
+    def __init__(self, chunk=CHUNK, rate=RATE, ranges=RANGES, min_freq=MIN_FREQ, history_size=HISTORY_SIZE,
+                 window="rect", fft_backend="auto"):
+        # Everything the chain was built from; compare to decide on a rebuild
+        self.config = (chunk, rate, tuple(map(tuple, ranges)), min_freq, history_size, window, fft_backend)
+        self.chunk = chunk
+        self.rate = rate
+        self.fft = PowerSpectrum(chunk, window=window, backend=fft_backend)
+        self.bands = BandAnalyzer(ranges, chunk, rate)
+        self.chroma_analyzer = ChromaAnalyzer(chunk, rate, min_freq=min_freq)
+        self.normalizer = LevelNormalizer(len(self.bands), window=history_size)
+
+        self.band_filters = FilterBank()
+        for i in range(len(self.bands)):
+            self.band_filters.add("band%d" % i, "lpf", alpha=0.3, value=0.0)
+
+        self.filters = FilterBank()
+        self.filters.add("dhue", "circ", alpha=0.01)
+        self.filters.add("bass_val", "lpf", alpha=0.02)
+        self.filters.add("treble_size", "lpf", alpha=0.01)
+        self.filters.add("treble_intens", "lpf", alpha=0.01)
+        self.filters.add("bass_size", "lpf", alpha=0.01)
+
+        self.levels = numpy.zeros(len(self.bands))
+        self.chroma = numpy.zeros(12)
+
+    @property
+    def lpf_audio(self):
+        return self.band_filters.state
+
+    def carry_state(self, old):
+        # Continue from another chain's smoothing state (e.g. one built by a
+        # reloaded module or with different settings) instead of starting cold
+        for name in old.filters.names:
+            i = old.filters.index[name]
+            if name not in self.filters:
+                kind = [k for k, v in FilterBank.KINDS.items() if v == old.filters.kind[i]][0]
+                self.filters.add(name, kind, alpha=old.filters.alpha[i], dalpha=old.filters.dalpha[i])
+            self.filters.state[self.filters.index[name]] = old.filters.state[i]
+        if len(old.bands) == len(self.bands):
+            self.band_filters.state[:] = old.band_filters.state
+            for values in old.normalizer.history[-len(self.normalizer.ring):]:
+                self.normalizer.push(values)
+            self.levels = old.levels.copy()
+        self.chroma = numpy.array(old.chroma)
+
+    def spectrum(self, samples):
+        # Reuses one buffer; valid until the next call
+        return self.fft(samples)
+
+    def spectrum_batch(self, frames):
+        return self.fft.batch(frames)
+
+    def analyze(self, fft):
+        # Returns (band energies, raw hue, chroma)
+        hue, self.chroma = self.chroma_analyzer.analyze(fft)
+        return self.bands.energies(fft), hue, self.chroma
+
+    def analyze_batch(self, ffts):
+        hues, chromas = self.chroma_analyzer.analyze_batch(ffts)
+        return self.bands.energies_batch(ffts), hues, chromas
+
+    def smooth(self, bands, hue):
+        # Advance the stateful stages; returns normalized levels
+        self.band_filters.update(bands)
+        self.normalizer.push(self.band_filters.state)
+        levels = self.levels = self.normalizer.normalize(bands)
+        self.filters.update({
+            "dhue": hue,
+            "bass_val": max(min((levels[0]-0.1)/0.9,1.), 0.0),
+            "treble_size": levels[1],
+            "treble_intens": levels[3],
+            "bass_size": levels[0],
+        })
+        return levels
+
+class BeatTracker(object):
+    """
+    Real-time onset and tempo tracking from FFT power spectra.
+
+    Every frame adds one sample of log spectral flux to an onset envelope
+    covering the last `window` seconds, one slot per `frame_rate` hop. If
+    the caller skipped hops (e.g. CallbackCapture skipping ahead), pass
+    `steps` so the missing slots are filled and the time base stays right.
+    Every `interval` seconds the tempo is re-estimated from the envelope's
+    autocorrelation (weighted towards 120 bpm to avoid octave errors) and
+    the beat phase from a comb over the envelope at that period.
+
+    The tempo estimate is the only expensive step. It only runs in a frame
+    where the flux step plus its average cost fits in `budget` seconds, and
+    is postponed otherwise; after `interval` postponed frames it runs
+    anyway. The cost of each update is kept in `cost`, `cost_avg` and
+    `cost_max`, and `overruns` counts updates that went over budget.
+    """
+    def __init__(self, frame_rate, n_bins, window=6.0, min_bpm=80.0, max_bpm=180.0,
+                 interval=0.5, budget=0.002):
+        self.frame_rate = float(frame_rate)
+        self.size = int(window * frame_rate)
+        self.envelope = numpy.zeros(self.size)
+        self.n = 0
+        self.spec = numpy.zeros(n_bins)
+        self.prev_spec = numpy.zeros(n_bins)
+        self.diff = numpy.zeros(n_bins)
+
+        self.min_lag = max(2, int(frame_rate * 60.0 / max_bpm))
+        self.max_lag = min(self.size // 2, int(math.ceil(frame_rate * 60.0 / min_bpm)))
+        self.lags = numpy.arange(self.min_lag, self.max_lag + 1)
+        lag_bpm = 60.0 * self.frame_rate / self.lags
+        self.prior = numpy.exp(-0.5 * numpy.log2(lag_bpm / 120.0) ** 2)
+        self.nfft = 1 << int(math.ceil(math.log(2 * self.size, 2)))
+
+        self.interval = max(1, int(interval * frame_rate))
+        # Filler for skipped hops
+        self.flux_mean = 0.0
+        self.last_estimate = 0
+        self.pending = False
+        self.deferred = 0
+
+        self.bpm = None
+        self.beat_time = None
+        self.confidence = 0.0
+
+        self.budget = budget
+        self.cost = 0.0
+        self.cost_avg = 0.0
+        self.cost_max = 0.0
+        self.estimate_cost = 0.0
+        self.overruns = 0
+
+    def update(self, fft, now=None, steps=1):
+        # Returns True when a new tempo/phase estimate is available.
+        # `steps`: hops since the previous update (1 unless frames were skipped)
+        start = time.time()
+        if now is None:
+            now = start
+
+        numpy.log1p(fft, out=self.spec)
+        numpy.subtract(self.spec, self.prev_spec, out=self.diff)
+        numpy.maximum(self.diff, 0.0, out=self.diff)
+        flux = self.diff.sum() if self.n else 0.0
+        self.spec, self.prev_spec = self.prev_spec, self.spec
+
+        for i in range(min(steps, self.size) - 1):
+            self.envelope[(self.n + i) % self.size] = self.flux_mean
+        self.n += max(steps, 1) - 1
+        self.envelope[self.n % self.size] = flux
+        self.n += 1
+        self.flux_mean += 0.05 * (flux - self.flux_mean)
+
+        if self.n >= self.size // 2 and self.n - self.last_estimate >= self.interval:
+            self.pending = True
+            self.last_estimate = self.n
+
+        estimated = False
+        if self.pending:
+            if time.time() - start + self.estimate_cost <= self.budget or self.deferred >= self.interval:
+                estimate_start = time.time()
+                self.estimate(now)
+                self.estimate_cost += 0.2 * (time.time() - estimate_start - self.estimate_cost)
+                self.pending = False
+                self.deferred = 0
+                estimated = True
+            else:
+                self.deferred += 1
+
+        self.cost = time.time() - start
+        self.cost_avg += 0.05 * (self.cost - self.cost_avg)
+        self.cost_max = max(self.cost_max, self.cost)
+        if self.cost > self.budget:
+            self.overruns += 1
+        return estimated
+
+    def estimate(self, now):
+        if self.n < self.size:
+            env = self.envelope[:self.n]
+        else:
+            env = numpy.roll(self.envelope, -(self.n % self.size))
+        env = env - env.mean()
+
+        spectrum = numpy.fft.rfft(env, self.nfft)
+        ac = numpy.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2, self.nfft)
+        if ac[0] <= 0:
+            return
+        scores = ac[self.lags] * self.prior
+        i = scores.argmax()
+        lag = float(self.lags[i])
+        if 0 < i < len(scores) - 1:
+            # Parabolic interpolation between neighbouring lags
+            a, b, c = scores[i - 1], scores[i], scores[i + 1]
+            denom = a - 2 * b + c
+            if denom < 0:
+                lag += 0.5 * (a - c) / denom
+
+        # Comb over the envelope: which offset from "now" lines up with beats
+        beats = int(len(env) // lag)
+        offsets = numpy.arange(int(math.ceil(lag)))
+        positions = len(env) - 1 - offsets[:, None] - numpy.round(numpy.arange(beats) * lag).astype(numpy.intp)[None, :]
+        comb = numpy.where(positions >= 0, env[numpy.maximum(positions, 0)], 0.0).sum(axis=1)
+        best = comb.argmax()
+
+        self.bpm = 60.0 * self.frame_rate / lag
+        self.beat_time = now - best / self.frame_rate
+        self.confidence = float(ac[self.lags[i]] / ac[0])
@@ -1,8 +1,6 @@
-import collections
 import math
 import numpy
 import pyaudio
-import struct
 import threading
 import time
 import traceback
@@ -11,9 +9,11 @@ import doitlive
 from nanokontrol import Map as NKMap
 from grassroots import grassroots as gr
 
+import audio
 import projection
 import lights
 import devices
+import timing
 import ui_input
 
 from projection import *
@@ -44,17 +44,6 @@ def circ_lpf(data, mem, alpha):
     else:
         return resultw, resultw
 
-def sfilter(channel, fn, data, **kwargs):
-    history = sfilter.history.get(channel)
-    data, history = fn(data, history, **kwargs)
-    sfilter.history[channel] = history
-    return data
-sfilter.history = {}
-
-def waverage(data):
-    weight, total = map(sum, zip(*[(w, x*w) for x, w in data]))
-    return total / weight
-
 class Beetle(doitlive.SafeRefreshableLoop):
     STRIP_LENGTH=50
     #CHUNK = 1024
@@ -64,23 +53,53 @@ class Beetle(doitlive.SafeRefreshableLoop):
     CHANNELS = 1
     RATE = 48000
     HISTORY_SIZE = 200
+    # "blocking" reads one CHUNK per frame; "callback" analyzes overlapping
+    # CHUNK-sized windows every HOP samples (HOP=400 -> 120 frames/sec)
+    CAPTURE_MODE = "blocking"
+    HOP = 400
 
     RANGES = [(20,300),(300,1400),(1600,2800),(3000,6000)]
     MIN_FREQ = 200
+    FFT_WINDOW = "rect"
+    FFT_BACKEND = "auto" # "pyfftw", "scipy" or "numpy"; auto picks the fastest
+
+    RENDER_WORKERS = 0 # >0 renders strips across that many processes
+    RENDER_PIXELS = 16384 # minimum pixels the render processes' buffers hold
+    KEEPALIVE = 1.0 # seconds between resends of an unchanged strip
+    # Strip sid -> serial ports that drive it, e.g. {0x10: ["/dev/ttyUSB0"]};
+    # strips not listed go to every port, listed ones only to theirs
+    ROUTES = {}
+    DEVICE_PORTS = ['/dev/ttyUSB%d' % i for i in range(10)]
+    DEVICE_BAUDRATE = 3000000
+    MAX_DEVICES = 4
+    FRAME_RATE = 0 # output frames/sec; 0 sends each frame as soon as it's rendered
+
+    AUTO_BEAT_BANKS = [0, 1, 2, 3]
+    BEAT_BUDGET = 0.002 # seconds/frame for beat tracking
+
+    SPECTRUM_BINS = 64
+    SPECTRUM_MAX_FREQ = 4000
+    SPECTRUM_RATE = 10 # UI updates/sec
 
     def __init__(self, ui, *args, **kwargs):
         self.b = []
+        self.writers = {}
+        self.device_manager = None
+        self.chain = None
+        self.routes = devices.RoutingTable(self.ROUTES)
         self.ui = ui
         self.strips = [LightStrip(i) for i in range(3)]
+        self.strip_config()
+        self.init_renderer()
+        self.init_analysis()
         self.init_audio()
+        self.init_scheduler()
+        self.init_beat_tracking()
         self.min_fbin = 20
+        self.init_spectrum()
         self.alpha = 1.0
-        self.smooth_dict = {}
-        self.history=collections.deque()
-        self.lpf_audio=[0]*len(self.RANGES)
         self.i = 0
         self.projection = Plane()
-        self.strip_config()
         self.enumerate_devices()
         #self.nk = NanoKontrol2()
         self.nk = ui_input.NKController()
@@ -91,19 +110,30 @@ class Beetle(doitlive.SafeRefreshableLoop):
         super(doitlive.SafeRefreshableLoop, self).__init__(*args, **kwargs)
 
     def unsaturate(self):
-        h = self.history[-1]
-        self.history = collections.deque()
-        for i in range(self.HISTORY_SIZE):
-            self.history.append(h)
+        self.normalizer.reset()
+
+    def init_analysis(self):
+        old = self.chain
+        self.chain = audio.AnalysisChain(self.CHUNK, self.RATE, self.RANGES,
+            min_freq=self.MIN_FREQ,
+            history_size=self.HISTORY_SIZE,
+            window=self.FFT_WINDOW,
+            fft_backend=self.FFT_BACKEND)
+        if old is not None:
+            self.chain.carry_state(old)
+        self.bands = self.chain.bands
+        self.normalizer = self.chain.normalizer
+        self.filters = self.chain.filters
+        self.lpf_audio = self.chain.lpf_audio
+        self.chroma = self.chain.chroma
 
     def smooth(self, key, now, alpha=0.1, fn=None):
-        if not fn:
-            fn = lpf
-        if key not in self.smooth_dict:
-            self.smooth_dict[key] = now
-        output = fn(now, self.smooth_dict[key], alpha)
-        self.smooth_dict[key]  = output
-        return output
+        kind = {None: "lpf", lpf: "lpf", diode_lpf: "diode", circ_lpf: "circ"}[fn]
+        if key not in self.filters:
+            self.filters.add(key, kind, alpha=alpha)
+        self.filters.set_alpha(key, alpha)
+        self.filters.update({key: now})
+        return self.filters[key]
 
     def strip_config(self):
         self.strips[0].points = [(Point(0.0, 0.0), 50), 
@@ -125,68 +155,78 @@ class Beetle(doitlive.SafeRefreshableLoop):
         #self.strips[4].points = [(Point(0.15, 0.0), 50),  #TODO
         #                         (Point(0.15, 1.0), 0)] 
         #self.strips[4].sid = 0x18
+    def init_renderer(self):
+        # Start render processes before any audio/device threads exist
+        self.renderer = None
+        if self.RENDER_WORKERS:
+            # The shared buffers can't grow once the workers run: leave room
+            # for strips added by live edits
+            pixels = len(projection.StripGeometry().update(self.strips).positions)
+            self.renderer = projection.ParallelRenderer(self.RENDER_WORKERS,
+                max_pixels=max(self.RENDER_PIXELS, 2 * pixels))
+
     def render_strips(self):
-        for strip in self.strips:
-            if strip.sid == 0x10:
-                a = 1
-                #continue
-            self.projection.render_strip(strip)
+        if self.renderer is not None:
+            self.renderer.render_strips(self.projection, self.strips)
+        else:
+            self.projection.render_strips(self.strips)
+
+    def init_scheduler(self):
+        self.scheduler = timing.FrameScheduler(self.FRAME_RATE)
+        # Capture of the newest analyzed sample -> frame flushed to the port
+        self.latency = timing.LatencyMeter()
+        self.audio_time = time.time()
+        self.frame_time = self.audio_time
+
+    def emit_frame(self):
+        self.scheduler.wait()
+        self.hw_export_strips()
+        self.scheduler.done()
+        # Writers report frames once they are really out, including any
+        # wait behind an earlier write
+        for writer in self.writers.values():
+            while writer.completed:
+                (audio_time, predicted), submitted, flushed = writer.completed.popleft()
+                self.latency.update(flushed - audio_time)
+                self.scheduler.flushed(predicted, submitted, flushed)
+        self.ui.record('latency', self.latency.last * 1000)
+        self.ui.record('sched_err', self.scheduler.error.last * 1000)
 
     def hw_export_strips(self):
-        to_remove = set()
-        for strip in self.strips:
-            for d in self.b:
-                try:
-                    d.framed_packet(data=strip.hw_export(), addr=strip.sid, flags=0xFF)
-                except:
-                    print("ERROR sending data! Reload hardware!")
-                    to_remove.add(d)
-                    try:
-                        d.close()
-                    except:
-                        pass
-
+        # Hands the frame to each device's writer thread; never blocks on I/O
+        # No manager after free_devices(): nothing to send to
+        self.b = self.device_manager.devices() if self.device_manager is not None else []
+        for d in list(self.writers):
+            if d not in self.b:
+                self.writers.pop(d).close(0)
+        frames = [(strip.hw_export(), strip.sid, strip.priority) for strip in self.strips]
+        frame_rate = self.scheduler.frame_rate()
+        routed = self.routes.route(frames, self.b)
         for d in self.b:
-            try:
-                d.flush()
-            except:
-                print("ERROR sending data! Reload hardware!")
-                to_remove.add(d)
-                try:
-                    d.close()
-                except:
-                    pass
-        self.b = filter(lambda x: x not in to_remove, self.b)
-
-    def analyze_dom_freq(self, fft):
-        def maxat(a): return max(enumerate(a), key=lambda x: x[1])[0] 
-
-        freq = lambda b: self.RATE * float(b) / self.CHUNK
-        fbin = lambda f: int(self.CHUNK * f / self.RATE)
-        #dom_freq = self.RATE * dom_chk / self.CHUNK
-
-        octave_maxes = []
-        for o in range(12):
-            if (2 ** o) < self.MIN_FREQ:
-                continue
-            o_low = fbin(2 ** o)
-            o_high = fbin(2 ** (o + 1)) - 1
-            if o_low <= 1:
+            writer = self.writers.get(d)
+            if writer is None:
+                writer = self.writers[d] = devices.DeviceWriter(d)
+            if writer.error is not None:
+                # The manager closes it and reconnects in the background
+                self.writers.pop(d).close(0)
+                self.device_manager.lost(d, writer.error)
                 continue
-            samples = fft[o_low:o_high]
-            try:
-                dom_chk = maxat(samples) + o_low
-            except:
-                print o_low, o_high
-                raise
-            dom_freq = freq(dom_chk)
-            dom_amp = max(samples)
-            octave = 2.0 ** math.floor(math.log(dom_freq) / math.log(2))
+            writer.keepalive = self.KEEPALIVE
+            writer.bandwidth.frame_rate = frame_rate
+            writer.submit(routed[d], flags=0xFF, stamp=(self.audio_time, self.frame_time))
+
+        self.ui.record('dropped', sum(w.dropped for w in self.writers.values()))
+        for i, d in enumerate(self.b):
+            writer = self.writers.get(d)
+            if writer is not None:
+                self.ui.record("bandwidth[%d]" % i, writer.bandwidth.usage.last)
+        health = self.device_manager.health() if self.device_manager is not None else []
+        if health != self.ui.devices:
+            self.ui.devices = health
 
-            pos = (dom_freq - octave) / octave
-            octave_maxes.append((pos, dom_amp))
-
-        return waverage(octave_maxes)
+    def analyze_dom_freq(self, fft):
+        hue, self.chroma = self.chain.chroma_analyzer.analyze(fft)
+        return hue
 
     def step(self):
         self.ui.record('time', (time.time() - self.start_time) * 10)
@@ -197,7 +237,10 @@ class Beetle(doitlive.SafeRefreshableLoop):
         # --- Audio Math ---
 
         audio, fft = self.analyze_audio()
+        # Render for when this frame's light will leave the serial port
+        self.frame_time = self.scheduler.begin()
         self.write_spectrum(fft)
+        self.track_beats(fft)
         def maxat(a): return max(enumerate(a), key=lambda x: x[1])[0] 
 
         #self.mind =20 #self.inp(24, 4)
@@ -211,25 +254,18 @@ class Beetle(doitlive.SafeRefreshableLoop):
         #self.hue = ((dom_freq - octave) / octave)
 
 
-        #dom_freq = sfilter("dom_freq", data=dom_freq, fn=diode_lpf, alpha=0.08) #self.inp(14, 10) / 500.0)
+        #dom_freq = self.smooth("dom_freq", dom_freq, alpha=0.08, fn=diode_lpf) #self.inp(14, 10) / 500.0)
         #sys.stdout.write("\rdom_freq %d" % dom_freq)
 
         #self.octave = octave
         self.hue = self.analyze_dom_freq(fft)
         #self.hue = self.hue % 1.0
         self.ui.record('huer', self.hue)
-        self.hue = sfilter("dhue", data=self.hue, fn=circ_lpf, alpha=0.01)
-
-        self.lpf_audio=[lpf(float(data),mem,alpha=0.3)[0] for data,mem in zip(audio,self.lpf_audio)]
-
-        self.history.append(self.lpf_audio)
-        if len(self.history)>self.HISTORY_SIZE:
-            self.history.popleft()
 
-        scaling_factor=[max(max([d[j] for d in self.history]),1) for j in range(len(self.RANGES))]
-
-        #levels=[a/f for a,f in zip(self.lpf_audio,scaling_factor)]
-        levels=[rng(a/f) for a,f in zip(audio,scaling_factor)]
+        # Band low-pass, normalization and feature smoothing
+        levels = self.chain.smooth(audio, self.hue)
+        self.lpf_audio = self.chain.lpf_audio
+        self.hue = self.filters["dhue"]
 
         for i, l in enumerate(levels):
             self.ui.record("levels[%d]" % i, l)
@@ -237,10 +273,9 @@ class Beetle(doitlive.SafeRefreshableLoop):
 
         # --- Color picking ---
         self.hue = (self.hue + self.nk.state[NKMap.KNOBS[0]]) % 1.0
-        #self.hue = sfilter("hue", data=self.hue, alpha=0.04, fn=lpf)
+        #self.hue = self.smooth("hue", self.hue, alpha=0.04, fn=lpf)
 
-        bass_val = max(min((levels[0]-0.1)/0.9,1.), 0.0)
-        bass_val = sfilter("bass_val", data=bass_val, alpha=0.02, fn=lpf)
+        bass_val = self.filters["bass_val"]
         bass_hue = (self.hue + 0.95) % 1.0
         if bass_val < 0.0: # Switch colors for low bass values
             bass_hue = (bass_hue + 0.9) % 1.0
@@ -252,12 +287,12 @@ class Beetle(doitlive.SafeRefreshableLoop):
         bass_color= Color(h=bass_hue, s=1., v=bass_val, a=0.5)
 
         # --- Projection ---
-        self.projection.state["time"] = time.time()
+        self.projection.state["time"] = self.frame_time
 
         #treble_size = (0.5-0.3*levels[1]) 
-        treble_size = sfilter("treble_size", data=levels[1] , alpha=0.01, fn=lpf)
-        treble_intens = sfilter("treble_intens", data=levels[3] , alpha=0.01, fn=lpf)
-        bass_size = sfilter("bass_size", data=levels[0] , alpha=0.01, fn=lpf)
+        treble_size = self.filters["treble_size"]
+        treble_intens = self.filters["treble_intens"]
+        bass_size = self.filters["bass_size"]
         #treble_size = levels[2]
 
         #bg_alpha = self.inp(32) / 127.0
@@ -300,20 +335,20 @@ class Beetle(doitlive.SafeRefreshableLoop):
                 self.projection.effects.append(effect)
 
         def make_stripes(bank):
-            phase = self.nk.bank_beat(bank, cont=True)
+            phase = self.nk.bank_beat(bank, cont=True, at=self.frame_time)
             hue_offset = ((math.sin(phase * math.pi / 2.0) ** 2) ** 4) 
             y = (hue_offset * 0.3) + 0.2
             color = self.nk.bank_color(bank, yiq=y)
             size = 15 * (1 - self.nk.bank(bank, self.nkm.SIZE)) ** 3
             speed = self.nk.bank_speed(bank, a=15) 
-            phase = self.nk.bank_beat(bank, cont=True)
+            phase = self.nk.bank_beat(bank, cont=True, at=self.frame_time)
             bpm = self.nk.bank_bpm(bank)
             if color is not None:
                 #effect = eff_stripe_beat(Point(speed, speed), color, phase, gamma=size)
                 effect = eff_stripe_time(Point(0, speed), color, bpm / 40, gamma=size, key='stripe_%d' % bank)
 
                 if self.nk.bank_edge(bank, self.nkm.SYNC):
-                    self.projection.state["offset__st"] = 0
+                    self.projection.timers.reset('stripe_%d' % bank)
                 self.projection.effects.append(effect)
 
         def make_pulsar(bank):
@@ -323,7 +358,7 @@ class Beetle(doitlive.SafeRefreshableLoop):
             if self.nk.bank(bank, self.nkm.REVERSE, lpf=False):
                 size *= -1
             if alpha is not None:
-                phase = self.nk.bank_beat(bank, cont=True)
+                phase = self.nk.bank_beat(bank, cont=True, at=self.frame_time)
                 hue_offset = ((math.sin(phase * math.pi / 2.0) ** 2) ** gamma) * size
                 #self.hue = 0.1
                 bass_hue = (self.hue + self.nk.bank(bank, self.nkm.HUE)) % 1.0
@@ -383,15 +418,31 @@ class Beetle(doitlive.SafeRefreshableLoop):
         #strip.colors = [treble_color for i in range(20)]
         self.ui.debug = str(bass_color)
         self.render_strips()
-        self.hw_export_strips()
+        self.emit_frame()
         self.ui.flush_records()
 
+    def audio_settings(self):
+        # Everything the input stream was opened with
+        return (self.CAPTURE_MODE, self.CHUNK, self.HOP, self.RATE, self.CHANNELS, self.FORMAT)
+
     def init_audio(self):
         #pyaudio.pa.initialize(pyaudio.pa)
         self.pa=pyaudio.PyAudio()
+        self.audio_config = self.audio_settings()
 
         #devs=[self.pa.get_device_info_by_index(i) for i in range(self.pa.get_device_count())]
 
+        if self.CAPTURE_MODE == "callback":
+            self.in_stream = None
+            self.capture = audio.CallbackCapture(self.pa,
+                chunk=self.CHUNK,
+                hop=self.HOP,
+                rate=self.RATE,
+                channels=self.CHANNELS,
+                format=self.FORMAT)
+            return
+
+        self.capture = None
         self.in_stream = self.pa.open(
             format=self.FORMAT,
             channels=self.CHANNELS,
@@ -399,69 +450,120 @@ class Beetle(doitlive.SafeRefreshableLoop):
             input=True,
             frames_per_buffer=self.CHUNK)
 
-    def analyze_audio(self):
+    def free_audio(self):
+        if self.capture is not None:
+            self.capture.close()
+        else:
+            self.in_stream.stop_stream()
+            self.in_stream.close()
+        self.pa.terminate()
+
+    def init_beat_tracking(self):
+        hop = self.HOP if self.capture is not None else self.CHUNK
+        self.beat_tracker = audio.BeatTracker(self.RATE / float(hop), self.CHUNK // 2 + 1,
+            budget=self.BEAT_BUDGET)
+
+    def track_beats(self, fft):
+        tracker = self.beat_tracker
+        steps = 1 + (self.capture.last_skipped if self.capture is not None else 0)
+        if tracker.update(fft, self.audio_time, steps) and tracker.confidence > 0.3:
+            for bank in self.AUTO_BEAT_BANKS:
+                self.nk.set_bank_tempo(bank, tracker.bpm, tracker.beat_time)
+        self.ui.record('beat_cost', tracker.cost / tracker.budget)
+
+    def read_audio(self):
+        # Also sets `audio_time`: when the newest sample was captured
+        if self.capture is not None:
+            samples = self.capture.read()
+            self.audio_time = self.capture.window_time
+            return samples
         data = self.in_stream.read(self.CHUNK)
-        samples = struct.unpack('h'*self.CHUNK,data)
-        #fft = pyfftw.interfaces.numpy_fft.rfft(samples)
-        fft=numpy.fft.rfft(samples)
-        fft=abs(fft)**2
-        out=[]
-        for (low,high) in self.RANGES:
-            low_bucket=int(self.CHUNK*low/self.RATE)
-            high_bucket=int(self.CHUNK*high/self.RATE)
-            result=sum(fft[low_bucket:high_bucket])
-            out.append(result)
-        return out, fft
+        self.audio_time = time.time() - self.in_stream.get_input_latency()
+        return audio.decode_samples(data)
+
+    def analyze_audio(self):
+        samples = self.read_audio()
+        fft = self.chain.spectrum(samples)
+        return self.bands.energies(fft), fft
+
+    def init_spectrum(self):
+        self.spectrum_publisher = audio.SpectrumPublisher(self.CHUNK, self.RATE,
+            n_bins=self.SPECTRUM_BINS,
+            max_freq=self.SPECTRUM_MAX_FREQ,
+            min_bin=self.min_fbin,
+            ui_rate=self.SPECTRUM_RATE)
+        self.ui.spectrum_freqs = self.spectrum_publisher.freqs
 
     def write_spectrum(self, fft):
-        fft = map(math.log1p, fft)
-        mval = max(fft)
-        mind = self.min_fbin
-        def maxat(a): return max(enumerate(a), key=lambda x: x[1])[0] 
-        dom_chk = maxat(fft[mind:-mind]) + mind
-        dom_freq = self.RATE * dom_chk / self.CHUNK
-        ranges = [mval * x  for x in [0.95, 0.9, 0.7, 0.5, 0.4]] #[0.6, 0.4, 0.2, 0.1, 0.05]]
-        spec_max = 80
-        spec_range = fft[0:spec_max]
-        self.ui.spectrum = ("max @: %d; mind: %d\n" % (dom_chk, mind))
-        for r in ranges:
-            self.ui.spectrum += ("".join([' ' if v < r else '#' for v in spec_range])) + "\n"
-        for s in range(spec_max)[::7]:
-            freq = int(self.RATE * s / self.CHUNK)
-            self.ui.spectrum += ("|{: <6}".format(freq))
+        spectrum = self.spectrum_publisher.update(fft)
+        if spectrum is not None:
+            self.ui.spectrum, self.ui.spectrum_peak = spectrum
 
     def pre_refresh(self):
+        reload(audio)
         reload(projection)
         reload(lights)
+        reload(timing)
         reload(doitlive)
 
     def post_refresh(self):
+        # Rebuild on any setting change, and after reload(audio) so the chain
+        # runs the new code
+        rebuild = type(self.chain) is not audio.AnalysisChain or self.chain.config != (
+            self.CHUNK, self.RATE, tuple(map(tuple, self.RANGES)), self.MIN_FREQ,
+            self.HISTORY_SIZE, self.FFT_WINDOW, self.FFT_BACKEND)
+        if rebuild:
+            self.init_analysis()
+        if self.audio_config != self.audio_settings():
+            # New window size, hop or format: reopen the input
+            self.free_audio()
+            self.init_audio()
+            rebuild = True
+        if rebuild or type(self.beat_tracker) is not audio.BeatTracker:
+            # Its bins and frame rate follow CHUNK, HOP and RATE
+            self.init_beat_tracking()
+        self.init_spectrum()
+        if self.scheduler.rate != self.FRAME_RATE:
+            self.scheduler.set_rate(self.FRAME_RATE)
         self.strip_config()
+        self.routes = devices.RoutingTable(self.ROUTES)
+        self.projection.invalidate_geometry()
+        if self.renderer is not None:
+            # Forking new workers now would copy the audio and device
+            # threads' locks mid-use, so the running ones reload in place;
+            # a new worker count needs a restart
+            if self.RENDER_WORKERS:
+                self.renderer.reload()
+            else:
+                self.renderer.close()
+                self.renderer = None
 
     def enumerate_devices(self):
+        # Devices connect (and reconnect) in the background; see device_health()
         self.free_devices()
-        self.b = []
-        for i in range(10):
-            try:
-                #self.b.append(devices.SingleBespeckleDevice('/dev/ttyUSB%d' % i, 460800))
-                self.b.append(devices.SingleBespeckleDevice('/dev/ttyUSB%d' % i, 3000000))
-                #self.b.append(devices.SingleBespeckleDevice('/dev/ttyUSB%d' % i, 115200))
-                #self.b.append(devices.SingleBespeckleDevice('/dev/ttyUSB%d' % i, 9600))
-                if len(b) >= 4:
-                    break
-            except:
-                pass
-        print "Enumerated {0} devices.".format(len(self.b))
+        self.device_manager = devices.HotplugManager(self.DEVICE_PORTS, self.DEVICE_BAUDRATE,
+            max_devices=self.MAX_DEVICES)
+        print "Probing {0} ports for devices.".format(len(self.DEVICE_PORTS))
+
+    def device_health(self):
+        return self.device_manager.health() if self.device_manager is not None else []
 
     def free_devices(self):
-        for b in self.b:
-            b.close()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        if self.device_manager is not None:
+            self.device_manager.close()
+            self.device_manager = None
         self.b = []
 
 class BeetleUI(gr.Blade):
     tick = gr.Field(0)
     color = gr.Field("rgb(100,30,50)")
-    spectrum = gr.Field("")
+    spectrum = gr.Field([])
+    spectrum_freqs = gr.Field([])
+    spectrum_peak = gr.Field(0)
+    devices = gr.Field([])
     levels = gr.Field([])
     debug = gr.Field("")
 
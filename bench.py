@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the audio analysis chain, using synthetic signals so no
+sound card or NanoKontrol is needed.
+
+    ./bench.py --save before.json
+    ./bench.py --compare before.json
+
+Reports per-frame latency percentiles and transient allocations for each
+stage of Beetle.step's audio math, as a share of the frame budget.
+"""
+import argparse
+import collections
+import json
+import numpy
+import platform
+import time
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import audio
+import offline
+
+def sine(n, rate, freq=440.0):
+    t = numpy.arange(n) / float(rate)
+    return 12000 * numpy.sin(2 * numpy.pi * freq * t)
+
+def chirp(n, rate, f0=40.0, f1=8000.0):
+    # Exponential sweep from f0 to f1 over the whole signal
+    t = numpy.arange(n) / float(rate)
+    k = (f1 / f0) ** (1.0 / t[-1])
+    phase = 2 * numpy.pi * f0 * (k ** t - 1) / numpy.log(k)
+    return 12000 * numpy.sin(phase)
+
+def pink_noise(n, rate, seed=0):
+    spectrum = numpy.fft.rfft(numpy.random.RandomState(seed).randn(n))
+    f = numpy.arange(len(spectrum), dtype=float)
+    f[0] = 1.0
+    x = numpy.fft.irfft(spectrum / numpy.sqrt(f), n)
+    return 8000 * x / numpy.abs(x).max()
+
+def kick_pattern(n, rate, bpm=128.0, seed=0):
+    x = 200 * numpy.random.RandomState(seed).randn(n)
+    length = int(0.15 * rate)
+    t = numpy.arange(length) / float(rate)
+    kick = 20000 * numpy.sin(2 * numpy.pi * (50 + 100 * numpy.exp(-t * 40)) * t) * numpy.exp(-t * 20)
+    for start in range(0, n - length, int(rate * 60.0 / bpm)):
+        x[start:start + length] += kick
+    return x
+
+SIGNALS = {
+    "sine": sine,
+    "chirp": chirp,
+    "pink": pink_noise,
+    "kick": kick_pattern,
+}
+
+def make_stages(chunk, rate, hop):
+    """
+    Stages of the analysis chain, in the order Beetle.step runs them. Each
+    reads and fills in a dict holding the frame's intermediate results.
+    """
+    chain = audio.AnalysisChain(chunk=chunk, rate=rate)
+    publisher = audio.SpectrumPublisher(chunk, rate)
+    tracker = audio.BeatTracker(rate / float(hop), chunk // 2 + 1)
+
+    def analyze_audio(frame):
+        frame["fft"] = chain.spectrum(frame["samples"])
+        frame["bands"] = chain.bands.energies(frame["fft"])
+
+    def analyze_dom_freq(frame):
+        frame["hue"], frame["chroma"] = chain.chroma_analyzer.analyze(frame["fft"])
+
+    def write_spectrum(frame):
+        # Always compute, as if every frame were due for publishing
+        publisher.compute(frame["fft"])
+
+    def track_beats(frame):
+        tracker.update(frame["fft"])
+
+    def normalize(frame):
+        chain.smooth(frame["bands"], frame["hue"])
+
+    return [
+        ("analyze_audio", analyze_audio),
+        ("analyze_dom_freq", analyze_dom_freq),
+        ("write_spectrum", write_spectrum),
+        ("track_beats", track_beats),
+        ("normalize", normalize),
+    ]
+
+def alloc_method():
+    # How transient allocations are measured, or None if they can't be
+    if tracemalloc is None:
+        return None
+    if hasattr(tracemalloc, "reset_peak"):
+        return "tracemalloc"
+    return "tracemalloc (clear_traces)"
+
+def run_signal(samples, chunk, rate, hop, measure_alloc=True):
+    frames = offline.frame_view(samples, chunk, hop)
+    stages = make_stages(chunk, rate, hop)
+    timings = numpy.zeros((len(frames), len(stages)))
+    clock = timeit.default_timer
+
+    for i, samples in enumerate(frames):
+        frame = {"samples": samples}
+        for j, (name, fn) in enumerate(stages):
+            start = clock()
+            fn(frame)
+            timings[i, j] = clock() - start
+
+    allocs = [None] * len(stages)
+    if measure_alloc and alloc_method() is not None:
+        # Separate pass: tracing slows everything down
+        stages = make_stages(chunk, rate, hop)
+        peaks = numpy.zeros((len(frames), len(stages)))
+        tracemalloc.start()
+        for i, samples in enumerate(frames):
+            frame = {"samples": samples}
+            for j, (name, fn) in enumerate(stages):
+                if hasattr(tracemalloc, "reset_peak"):
+                    base = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.reset_peak()
+                else:
+                    # Older tracemalloc (Python < 3.9, or the pytracemalloc
+                    # backport on 2.7) can only reset the peak by dropping
+                    # all traces, which also zeroes the current size
+                    tracemalloc.clear_traces()
+                    base = 0
+                fn(frame)
+                peaks[i, j] = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        allocs = peaks.mean(axis=0)
+
+    results = collections.OrderedDict()
+    for j, (name, fn) in enumerate(stages):
+        t = timings[1:, j] # The first frame warms caches
+        results[name] = {
+            "mean_us": 1e6 * t.mean(),
+            "p50_us": 1e6 * numpy.percentile(t, 50),
+            "p90_us": 1e6 * numpy.percentile(t, 90),
+            "p99_us": 1e6 * numpy.percentile(t, 99),
+            "max_us": 1e6 * t.max(),
+            "alloc_bytes": None if allocs[j] is None else float(allocs[j]),
+        }
+    total = timings[1:].sum(axis=1)
+    results["total"] = {
+        "mean_us": 1e6 * total.mean(),
+        "p50_us": 1e6 * numpy.percentile(total, 50),
+        "p90_us": 1e6 * numpy.percentile(total, 90),
+        "p99_us": 1e6 * numpy.percentile(total, 99),
+        "max_us": 1e6 * total.max(),
+        "alloc_bytes": None,
+    }
+    return results
+
+def print_results(results, budget_us, previous=None):
+    for signal, stages in sorted(results.items()):
+        print("\n{}".format(signal))
+        print("  {:<18}{:>9}{:>9}{:>9}{:>9}{:>9}{:>11}".format(
+            "stage", "p50 us", "p90 us", "p99 us", "max us", "%budget", "alloc B"))
+        for name, r in stages.items():
+            line = "  {:<18}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.2f}{:>11}".format(
+                name, r["p50_us"], r["p90_us"], r["p99_us"], r["max_us"],
+                100.0 * r["p99_us"] / budget_us,
+                "-" if r["alloc_bytes"] is None else int(r["alloc_bytes"]))
+            old = (previous or {}).get(signal, {}).get(name)
+            if old:
+                line += "  p50 x{:0.2f}".format(r["p50_us"] / max(old["p50_us"], 1e-9))
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Beetle audio analysis chain")
+    parser.add_argument("--chunk", type=int, default=audio.AnalysisChain.CHUNK)
+    parser.add_argument("--rate", type=int, default=audio.AnalysisChain.RATE)
+    parser.add_argument("--hop", type=int, default=None, help="Samples between frames (default: chunk)")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Length of each test signal")
+    parser.add_argument("--signals", default=",".join(sorted(SIGNALS)), help="Comma-separated signal names")
+    parser.add_argument("--no-alloc", action="store_true", help="Skip the allocation pass")
+    parser.add_argument("--save", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Compare against results saved with --save")
+    args = parser.parse_args()
+
+    hop = args.hop or args.chunk
+    n = int(args.seconds * args.rate)
+    results = {}
+    for name in args.signals.split(","):
+        samples = numpy.clip(SIGNALS[name](n, args.rate), -32768, 32767).astype(numpy.int16)
+        results[name] = run_signal(samples, args.chunk, args.rate, hop, measure_alloc=not args.no_alloc)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+
+    budget_us = 1e6 * hop / float(args.rate)
+    print("Frame budget: {:0.1f} ms (chunk={}, hop={}, rate={}); FFT backend: {}".format(
+        budget_us / 1000.0, args.chunk, hop, args.rate, audio.PowerSpectrum(args.chunk).backend))
+    if args.no_alloc:
+        print("alloc B: skipped (--no-alloc)")
+    elif alloc_method() is None:
+        print("alloc B: not measured, needs tracemalloc (Python 3.4+, or pytracemalloc on 2.7)")
+    else:
+        print("alloc B: peak bytes allocated per frame, via {}".format(alloc_method()))
+    print_results(results, budget_us, previous)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "time": time.time(),
+                    "python": platform.python_version(),
+                    "numpy": numpy.__version__,
+                    "chunk": args.chunk,
+                    "hop": hop,
+                    "rate": args.rate,
+                    "fft_backend": audio.PowerSpectrum(args.chunk).backend,
+                    "alloc": None if args.no_alloc else alloc_method(),
+                },
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
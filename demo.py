@@ -62,8 +62,7 @@ class DemoLightApp(gr.Blade, doitlive.SafeRefreshableLoop):
             self.projection.render_strip(self.strips[0])
             self.testprj.render_strip(self.strips[1])
         else:
-            for strip in self.strips:
-                self.projection.render_strip(strip)
+            self.projection.render_strips(self.strips)
 
     def hw_export_strips(self):
         for strip in self.strips:
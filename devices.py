@@ -1,8 +1,11 @@
+import collections
 import logging
 import threading
 import serial
 import time
 
+import timing
+
 logger = logging.getLogger(__name__)
 
 class DeviceManager(object):
@@ -55,6 +58,59 @@ class DeviceManager(object):
     def close(self):
         self.run_ticks = False
 
+class FrameEncoder(object):
+    """
+    Builds COBS-encoded Bespeckle frames into one reusable bytearray:
+
+        0x00, COBS(length, checksum, addr, flags, data + zero padding to 8)
+
+    Frames accumulate in `out` until the caller writes and clears it, so a
+    batch of frames can go out in a single write().
+    """
+    MIN_DATA = 8
+    MAX_DATA = 250
+
+    @classmethod
+    def encoded_size(cls, n):
+        # Bytes on the wire for `n` bytes of data: COBS replaces zeros in
+        # place, adding only the delimiter and the first code byte
+        return 2 + 4 + max(n, cls.MIN_DATA)
+
+    def __init__(self):
+        self.out = bytearray()
+        # Scratch frame: 4 header bytes, then data
+        self.frame = bytearray(4 + self.MAX_DATA)
+
+    def add(self, data, flags=0x00, addr=0x00):
+        n = len(data)
+        size = max(n, self.MIN_DATA)
+        frame = self.frame
+        frame[4:4 + n] = data
+        if n < size:
+            frame[4 + n:4 + size] = bytearray(size - n)
+        frame[0] = size
+        frame[1] = (addr + flags + sum(data)) & 0xff
+        frame[2] = addr
+        frame[3] = flags
+        self.cobs(frame, 4 + size)
+
+    def cobs(self, data, end=None):
+        # Appends a delimiter and `data[:end]` with each zero replaced by
+        # the distance to the next one (or the end)
+        out = self.out
+        end = len(data) if end is None else end
+        out.append(0)
+        start = 0
+        while True:
+            z = data.find(b"\x00", start, end)
+            if z < 0:
+                z = end
+            out.append(z - start + 1)
+            out += data[start:z]
+            if z == end:
+                return
+            start = z + 1
+
 class SingleBespeckleDevice(object):
     """
     Abstraction for sending data to a single Bespeckle-based device
@@ -67,46 +123,87 @@ class SingleBespeckleDevice(object):
     CMD_STOP = 0x82
     CMD_PARAM = 0x85
 
+    # Seconds before a write to a wedged adapter fails instead of hanging
+    WRITE_TIMEOUT = 0.5
+
     def __init__(self, port, baudrate=115200):
-        self.ser = serial.Serial(port, baudrate)
+        self.ser = serial.Serial(port, baudrate, writeTimeout=self.WRITE_TIMEOUT)
+        self.port = port
+        self.baudrate = baudrate
         self.addresses = {}
         self.bespeckle_ids = set()
+        self.last_frames = {}
+        self.encoder = FrameEncoder()
+        self.batching = False
+        self.lock = threading.Lock()
 
     def close(self):
         self.ser.close()
 
     def raw_packet(self, data):
-        logger.debug("Serial Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
-        #print ("Serial Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
-        self.ser.write("".join([chr(d) for d in data]))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Serial Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), bytearray(data))))
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytearray(data)
+        self.ser.write(data)
 
     def flush(self):
+        self.end_batch()
         self.ser.flush()
 
+    def begin_batch(self):
+        # Hold frames until end_batch()/flush() and write them all at once
+        self.batching = True
+
+    def end_batch(self):
+        with self.lock:
+            self.batching = False
+            self._write_pending()
+
+    def _write_pending(self):
+        if self.encoder.out:
+            self.raw_packet(self.encoder.out)
+            del self.encoder.out[:]
+
     def cobs_packet(self, data):
-        #print ("Not encoded: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
-        rdata = []
-        i = 0
-        for d in data[::-1]:
-            i += 1
-            if d == 0:
-                rdata.append(i)
-                i = 0
-            else:
-                rdata.append(d)
-        self.raw_packet([0, i+1] + rdata[::-1])
-        
+        with self.lock:
+            self.encoder.cobs(bytearray(data))
+            if not self.batching:
+                self._write_pending()
 
     def framed_packet(self, data=None, flags=0x00, addr=0x00):
-        if data is None or len(data) > 250:
+        if data is None or len(data) > FrameEncoder.MAX_DATA:
             raise Exception("invalid data")
-        data=list(data)
-        while len(data) < 8:
-            data.append(0)
-        crc_frame = [addr, flags] + data
-        checksum = sum(crc_frame) & 0xff
-        frame = [len(data), checksum] + crc_frame
-        self.cobs_packet(frame)
+        with self.lock:
+            self.encoder.add(data, flags=flags, addr=addr)
+            if not self.batching:
+                self._write_pending()
+
+    def send_frame(self, data, addr, flags=0x00, keepalive=None):
+        """
+        Sends `data` to `addr` unless it is the same frame that was last sent
+        there, less than `keepalive` seconds ago. Returns True if sent.
+        """
+        now = time.time()
+        if self.is_repeat(data, addr, flags, keepalive, now):
+            return False
+        self.framed_packet(data=data, flags=flags, addr=addr)
+        self.last_frames[addr] = (data, flags, now)
+        return True
+
+    def is_repeat(self, data, addr, flags=0x00, keepalive=None, now=None):
+        # True if send_frame() would skip this frame
+        last = self.last_frames.get(addr)
+        if keepalive is None or last is None:
+            return False
+        last_data, last_flags, last_time = last
+        if now is None:
+            now = time.time()
+        return now - last_time < keepalive and last_flags == flags and (last_data is data or last_data == data)
+
+    def last_sent(self, addr):
+        last = self.last_frames.get(addr)
+        return last[2] if last is not None else None
 
     def _get_next_id(self):
         for i in range(256):
@@ -153,10 +250,322 @@ class SingleBespeckleDevice(object):
 
 class FakeSingleBespeckleDevice(SingleBespeckleDevice):
     def __init__(self, *args, **kwargs):
+        self.port = args[0] if args else kwargs.get("port")
+        self.baudrate = kwargs.get("baudrate")
         self.addresses = {}
         self.bespeckle_ids = set()
+        self.last_frames = {}
+        self.encoder = FrameEncoder()
+        self.batching = False
+        self.lock = threading.Lock()
 
     def raw_packet(self, data):
-        logger.debug("Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), data)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Data: %s", ';'.join(map(lambda x: "{:02x}".format(x), bytearray(data))))
         time.sleep(0.001)
 
+    def flush(self):
+        self.end_batch()
+
+
+class RoutingTable(object):
+    """
+    Which serial ports each strip address is sent to: `routes` maps a sid
+    to a list of port names. Strips with no route are sent to every device
+    as before. A routed strip whose ports are all missing (e.g. unplugged)
+    is not sent anywhere until one comes back.
+    """
+    def __init__(self, routes=None):
+        self.routes = dict(routes or {})
+        self.missing = set()
+
+    def route(self, frames, devices):
+        # frames: [(data, sid, ...)] -> {device: [frames for that device]}
+        by_port = {}
+        for d in devices:
+            by_port.setdefault(getattr(d, "port", None), []).append(d)
+        out = dict((d, []) for d in devices)
+        for frame in frames:
+            sid = frame[1]
+            if sid not in self.routes:
+                targets = devices
+            else:
+                targets = [d for port in self.routes[sid] for d in by_port.get(port, [])]
+                if not targets and sid not in self.missing:
+                    logger.warning("No device for strip %#x on %s; not sending it", sid, self.routes[sid])
+                    self.missing.add(sid)
+                elif targets:
+                    self.missing.discard(sid)
+            for d in targets:
+                out[d].append(frame)
+        return out
+
+# Serial 8N1: a start and a stop bit around every byte
+WIRE_BITS_PER_BYTE = 10
+
+class BandwidthBudget(object):
+    """
+    Picks which strips a device gets each frame so that the frame fits in
+    what the serial port can carry at `frame_rate` (less `headroom`).
+
+    Strips that would repeat their last frame cost nothing. The rest are
+    ranked by priority times staleness (time since the strip was last
+    sent), so when a port is over budget every strip still gets updated,
+    just less often, and never-sent strips go first. `usage` tracks the
+    fraction of the budget used per frame.
+    """
+    def __init__(self, baudrate=None, frame_rate=None, headroom=0.9):
+        self.baudrate = baudrate
+        self.frame_rate = frame_rate
+        self.headroom = headroom
+        self.usage = timing.LatencyMeter()
+        self.deferred = 0
+
+    def budget(self):
+        # Bytes per frame, or None if unlimited
+        if not self.baudrate or not self.frame_rate:
+            return None
+        return self.baudrate * self.headroom / float(WIRE_BITS_PER_BYTE * self.frame_rate)
+
+    def select(self, device, frames, flags=0x00, keepalive=None, now=None):
+        # frames: [(data, addr, priority)] -> [(data, addr)] to send
+        if now is None:
+            now = time.time()
+        budget = self.budget()
+        candidates = []
+        for data, addr, priority in frames:
+            if device.is_repeat(data, addr, flags, keepalive, now):
+                continue
+            staleness = now - (device.last_sent(addr) or 0.0)
+            candidates.append((priority * staleness, FrameEncoder.encoded_size(len(data)), data, addr))
+        if budget is None:
+            self.usage.update(0.0)
+            return [(data, addr) for score, size, data, addr in candidates]
+
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        selected = []
+        used = 0
+        for score, size, data, addr in candidates:
+            if used + size <= budget:
+                selected.append((data, addr))
+                used += size
+        self.deferred += len(candidates) - len(selected)
+        self.usage.update(used / budget)
+        return selected
+
+class DeviceWriter(object):
+    """
+    Writes frames to one device from its own thread, so a slow or stuck
+    serial port never holds up the render loop.
+
+    submit() doesn't block: each device has a single-slot mailbox, and a
+    frame the writer hasn't picked up yet is replaced by the newer one and
+    counted in `dropped`. If a write fails the thread stops and keeps the
+    exception in `error`. `bandwidth` decides which strips of a frame fit
+    the port.
+
+    For every frame actually flushed, `completed` gets a tuple of the
+    `stamp` it was submitted with, the submit time and the flush time.
+    """
+    def __init__(self, device, keepalive=None):
+        self.device = device
+        self.keepalive = keepalive
+        self.bandwidth = BandwidthBudget(getattr(device, "baudrate", None))
+        self.cond = threading.Condition()
+        self.pending = None
+        self.running = True
+        self.error = None
+        self.written = 0
+        self.dropped = 0
+        self.write_time = timing.LatencyMeter()
+        self.completed = collections.deque(maxlen=100)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, frames, flags=0x00, stamp=None):
+        # frames: [(data, addr, priority)], sent together as one batch
+        with self.cond:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = (frames, flags, stamp, time.time())
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                frames, flags, stamp, submitted = self.pending
+                self.pending = None
+            start = time.time()
+            try:
+                frames = self.bandwidth.select(self.device, frames, flags, self.keepalive, start)
+                self.device.begin_batch()
+                for data, addr in frames:
+                    self.device.send_frame(data, addr=addr, flags=flags, keepalive=self.keepalive)
+                self.device.flush()
+            except Exception as e:
+                logger.exception("Error writing to device")
+                self.error = e
+                return
+            flushed = time.time()
+            self.write_time.update(flushed - start)
+            self.completed.append((stamp, submitted, flushed))
+            self.written += 1
+
+    def close(self, timeout=1.0):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(timeout)
+
+class PortStatus(object):
+    """
+    Connection state of one serial port watched by a HotplugManager.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.device = None
+        self.probing = False
+        # A lost device is still being closed; don't reopen the port yet
+        self.closing = False
+        self.connects = 0
+        self.failures = 0
+        self.last_error = None
+        self.next_try = 0.0
+        self.backoff = None
+
+    @property
+    def reconnects(self):
+        return max(0, self.connects - 1)
+
+    def health(self):
+        return {
+            "port": self.port,
+            "connected": self.device is not None,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "last_error": None if self.last_error is None else str(self.last_error),
+        }
+
+class HotplugManager(object):
+    """
+    Keeps devices open on a list of serial ports from a background thread.
+
+    Ports are probed in parallel, each in its own short-lived thread, so a
+    slow port can't hold up the others or the caller. A port that fails to
+    open is retried with exponential backoff from `min_backoff` up to
+    `max_backoff` seconds; a device that was working and then failed
+    (reported with `lost()`, e.g. after a write timeout) is retried after
+    `min_backoff`. `devices()` returns the currently connected devices
+    without blocking.
+    """
+    def __init__(self, ports, baudrate=115200, max_devices=None, interval=0.2,
+                 min_backoff=0.5, max_backoff=10.0, opener=None):
+        self.baudrate = baudrate
+        self.max_devices = max_devices
+        self.interval = interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.opener = opener or SingleBespeckleDevice
+        self.status = [PortStatus(port) for port in ports]
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def devices(self):
+        with self.lock:
+            return [s.device for s in self.status if s.device is not None]
+
+    def health(self):
+        with self.lock:
+            return [s.health() for s in self.status]
+
+    def lost(self, device, error=None):
+        # Called when writing to `device` failed: close it and reconnect.
+        # The close runs in its own thread, since closing a wedged tty can
+        # block for its closing_wait (30s on Linux) and the caller is
+        # usually the render loop.
+        port = None
+        with self.lock:
+            for s in self.status:
+                if s.device is device:
+                    s.device = None
+                    s.closing = True
+                    s.failures += 1
+                    s.last_error = error
+                    s.backoff = None
+                    s.next_try = time.time() + self.min_backoff
+                    port = s
+                    logger.warning("Lost device on %s (%s); reconnecting", s.port, error)
+        thread = threading.Thread(target=self._close, args=(port, device))
+        thread.daemon = True
+        thread.start()
+
+    def _close(self, s, device):
+        try:
+            device.close()
+        except Exception:
+            pass
+        if s is not None:
+            with self.lock:
+                s.closing = False
+
+    def run(self):
+        while self.running:
+            now = time.time()
+            with self.lock:
+                connected = sum(1 for s in self.status if s.device is not None or s.probing)
+                due = []
+                for s in self.status:
+                    if s.device is not None or s.probing or s.closing or s.next_try > now:
+                        continue
+                    if self.max_devices is not None and connected >= self.max_devices:
+                        break
+                    s.probing = True
+                    connected += 1
+                    due.append(s)
+            for s in due:
+                thread = threading.Thread(target=self._probe, args=(s,))
+                thread.daemon = True
+                thread.start()
+            time.sleep(self.interval)
+
+    def _probe(self, s):
+        try:
+            device = self.opener(s.port, self.baudrate)
+        except Exception as e:
+            with self.lock:
+                s.probing = False
+                s.last_error = e
+                s.backoff = self.min_backoff if s.backoff is None else min(2 * s.backoff, self.max_backoff)
+                s.next_try = time.time() + s.backoff
+            return
+        with self.lock:
+            s.probing = False
+            if not self.running:
+                device.close()
+                return
+            s.device = device
+            s.connects += 1
+            s.backoff = None
+            s.last_error = None
+        logger.info("Connected device on %s", s.port)
+
+    def close(self):
+        self.running = False
+        self.thread.join(1.0)
+        for device in self.devices():
+            try:
+                device.close()
+            except Exception:
+                pass
+        with self.lock:
+            for s in self.status:
+                s.device = None
@@ -1,8 +1,8 @@
 import IPython
 import collections
 import colorsys
-import copy
 import math
+import numpy
 import struct
 
 from grassroots import grassroots as gr 
@@ -36,7 +36,22 @@ class Color(object):
             raise ValueError("Invalid color specification.")
 
     def copy(self):
-        return copy.deepcopy(self)
+        c = Color.__new__(Color)
+        c.__setstate__(self.__getstate__())
+        return c
+
+    def __getstate__(self):
+        # __slots__ classes need this to pickle (e.g. to render processes)
+        return [getattr(self, k) for k in self.__slots__]
+
+    def __reduce__(self):
+        # Rebuilt by a module-level function instead of the class, so Colors
+        # made before doitlive reloaded this module still pickle
+        return (_color_from_state, (self.__getstate__(),))
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
 
     def mix_onbg(self, oc):
         blend = lambda t, b: rng((t * self.a) + (b * (1.0 - self.a)))
@@ -82,7 +97,7 @@ class Color(object):
         self.set_rgb(r, g, b)
 
     def hsv_from_rgb(self):
-        self.h, self.s, self.v = colorsys.hsv_to_rgb(self.r, self.g, self.b)
+        self.h, self.s, self.v = colorsys.rgb_to_hsv(self.r, self.g, self.b)
 
     def rgb_from_hsv(self):
         self.r, self.g, self.b = colorsys.hsv_to_rgb(self.h, self.s, self.v)
@@ -113,6 +128,11 @@ class Color(object):
         f = lambda x: int(round(x * 255 * self.a))
         return "rgb({}, {}, {})".format(f(self.r), f(self.g), f(self.b))
 
+def _color_from_state(state):
+    c = Color.__new__(Color)
+    c.__setstate__(state)
+    return c
+
 Black = lambda: Color(r=0, g=0, b=0, a=1)
 White = lambda: Color(r=1, g=1, b=1, a=1)
 
@@ -126,29 +146,272 @@ def yiq_from_phase(y=0.5, phase=0.0, kappa=1.0, a=1.0):
     color.a = a
     return color
 
+def rgb_from_phase(y=0.5, phase=0.0, kappa=1.0):
+    # Array version of yiq_from_phase: one RGB row per phase
+    phase = numpy.asarray(phase, dtype=float)
+    hues, huec = numpy.sin(phase * 2 * math.pi), numpy.cos(phase * 2 * math.pi)
+    yiq = numpy.empty(phase.shape + (3,))
+    yiq[..., 0] = y
+    yiq[..., 1] = numpy.abs(hues) ** kappa * numpy.where(hues < 0, -1.0, 1.0) * 0.595
+    yiq[..., 2] = numpy.abs(huec) ** kappa * numpy.where(huec < 0, -1.0, 1.0) * 0.522
+    return yiq_to_rgb(yiq)
+
+# Array versions of the colorsys conversions: the last axis holds the
+# three components, e.g. an N x 3 array of RGB rows
+
+def rgb_to_hsv(rgb):
+    rgb = numpy.asarray(rgb, dtype=float)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = rgb.max(axis=-1)
+    delta = maxc - rgb.min(axis=-1)
+    gray = delta == 0
+    safe_delta = numpy.where(gray, 1.0, delta)
+    rc = (maxc - r) / safe_delta
+    gc = (maxc - g) / safe_delta
+    bc = (maxc - b) / safe_delta
+    h = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    hsv = numpy.empty(rgb.shape)
+    hsv[..., 0] = numpy.where(gray, 0.0, (h / 6.0) % 1.0)
+    hsv[..., 1] = numpy.where(gray, 0.0, delta / numpy.where(gray, 1.0, maxc))
+    hsv[..., 2] = maxc
+    return hsv
+
+def hsv_to_rgb(hsv):
+    hsv = numpy.asarray(hsv, dtype=float)
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    h6 = (h % 1.0) * 6.0
+    i = numpy.floor(h6).astype(int) % 6
+    f = h6 - numpy.floor(h6)
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    rgb = numpy.empty(hsv.shape)
+    rgb[..., 0] = numpy.choose(i, [v, q, p, p, t, v])
+    rgb[..., 1] = numpy.choose(i, [t, v, v, q, p, p])
+    rgb[..., 2] = numpy.choose(i, [p, p, t, v, v, q])
+    return rgb
+
+def rgb_to_yiq(rgb):
+    return numpy.dot(numpy.asarray(rgb, dtype=float), numpy.array([
+        [0.30, 0.60, 0.21],
+        [0.59, -0.28, -0.52],
+        [0.11, -0.32, 0.31]]))
+
+def yiq_to_rgb(yiq):
+    # Same coefficients and clamping as colorsys.yiq_to_rgb
+    rgb = numpy.dot(numpy.asarray(yiq, dtype=float), numpy.array([
+        [1.0, 1.0, 1.0],
+        [0.948262, -0.276066, -1.105450],
+        [0.624013, -0.639810, 1.729860]]))
+    return numpy.clip(rgb, 0.0, 1.0, out=rgb)
+
+class ColorBuffer(object):
+    """
+    Many colors stored as an N x 4 array of RGBA floats, so whole strips
+    can be blended and converted without a Color object per pixel.
+
+    The mix_* methods work like `top.mix_*(color)` for every color in the
+    buffer, but modify the buffer in place. `top` is a Color, a ColorBuffer
+    of the same length, or an RGB array (one color, or one row per pixel);
+    `alpha` replaces its alpha, and may also be one value per pixel.
+    """
+    __slots__ = ["rgba"]
+    def __init__(self, n=0, rgba=None):
+        if rgba is None:
+            rgba = numpy.zeros((n, 4))
+        # Wraps `rgba` without copying if it is already a float array
+        self.rgba = numpy.asarray(rgba, dtype=float).reshape(-1, 4)
+
+    @classmethod
+    def from_colors(cls, colors):
+        return cls(rgba=[(c.r, c.g, c.b, c.a) for c in colors])
+
+    @classmethod
+    def from_rgb(cls, rgb, a=1.0):
+        rgb = numpy.asarray(rgb, dtype=float).reshape(-1, 3)
+        buf = cls(len(rgb))
+        buf.rgba[:, :3] = rgb
+        buf.rgba[:, 3] = a
+        return buf
+
+    @classmethod
+    def from_hsv(cls, hsv, a=1.0):
+        return cls.from_rgb(hsv_to_rgb(hsv), a)
+
+    @classmethod
+    def from_yiq(cls, yiq, a=1.0):
+        return cls.from_rgb(yiq_to_rgb(yiq), a)
+
+    def __len__(self):
+        return len(self.rgba)
+
+    def __getitem__(self, i):
+        r, g, b, a = self.rgba[i].tolist()
+        return Color(r=r, g=g, b=b, a=a)
+
+    def __iter__(self):
+        for r, g, b, a in self.rgba.tolist():
+            yield Color(r=r, g=g, b=b, a=a)
+
+    def to_colors(self):
+        return list(self)
+
+    def copy(self):
+        return ColorBuffer(rgba=self.rgba.copy())
+
+    def fill(self, color):
+        self.rgba[:] = (color.r, color.g, color.b, color.a)
+
+    @property
+    def rgb(self):
+        return self.rgba[:, :3]
+
+    @property
+    def a(self):
+        return self.rgba[:, 3]
+
+    @property
+    def hsv(self):
+        return rgb_to_hsv(self.rgb)
+
+    @property
+    def yiq(self):
+        return rgb_to_yiq(self.rgb)
+
+    def set_rgb(self, rgb):
+        self.rgba[:, :3] = rgb
+
+    def set_hsv(self, hsv):
+        self.rgba[:, :3] = hsv_to_rgb(hsv)
+
+    def set_yiq(self, yiq):
+        self.rgba[:, :3] = yiq_to_rgb(yiq)
+
+    def _top(self, top, alpha=None):
+        # -> (rgb, alpha), each broadcastable against the buffer's rows
+        if isinstance(top, Color):
+            rgb, a = numpy.array([top.r, top.g, top.b]), top.a
+        elif isinstance(top, ColorBuffer):
+            rgb, a = top.rgb, top.a
+        else:
+            rgb, a = numpy.asarray(top, dtype=float), 1.0
+        a = numpy.asarray(a if alpha is None else alpha, dtype=float)
+        return rgb, (a[:, None] if a.ndim else a), a
+
+    def _top_hsv(self, top):
+        if isinstance(top, Color):
+            return numpy.array([top.h, top.s, top.v])
+        if isinstance(top, ColorBuffer):
+            return top.hsv
+        return rgb_to_hsv(top)
+
+    def _mix_alpha(self, a):
+        self.rgba[:, 3] = 1.0 - (1.0 - a) * (1.0 - self.rgba[:, 3])
+
+    def mix_onbg(self, top, alpha=None):
+        rgb, a, a_flat = self._top(top, alpha)
+        self.rgba[:, :3] = numpy.clip(rgb * a + self.rgba[:, :3] * (1.0 - a), 0.0, 1.0)
+        self._mix_alpha(a_flat)
+        return self
+
+    def mix_add(self, top, alpha=None):
+        rgb, a, a_flat = self._top(top, alpha)
+        self.rgba[:, :3] = numpy.clip(rgb * a + self.rgba[:, :3], 0.0, 1.0)
+        return self
+
+    def mix_sub(self, top, alpha=None):
+        rgb, a, a_flat = self._top(top, alpha)
+        self.rgba[:, :3] = numpy.clip(self.rgba[:, :3] - rgb * a, 0.0, 1.0)
+        return self
+
+    def _mix_hue(self, top, alpha, add):
+        rgb, a, a_flat = self._top(top, alpha)
+        top_hsv = self._top_hsv(top)
+        hsv = self.hsv
+        if add:
+            hsv[:, 0] = (top_hsv[..., 0] + hsv[:, 0]) % 1.0
+        else:
+            hsv[:, 0] = top_hsv[..., 0]
+        hsv[:, 1:] = numpy.clip(top_hsv[..., 1:] * a + hsv[:, 1:] * (1.0 - a), 0.0, 1.0)
+        self.set_hsv(hsv)
+        self._mix_alpha(a_flat)
+        return self
+
+    def mix_addhue(self, top, alpha=None):
+        return self._mix_hue(top, alpha, add=True)
+
+    def mix_takehue(self, top, alpha=None):
+        return self._mix_hue(top, alpha, add=False)
+
+class Calibration(object):
+    """
+    Per-channel lookup tables from color values to 5-bit hardware levels:
+    round(gain * (alpha * value) ** gamma * 0x1F). Each strip can have its
+    own, to correct gamma and white balance; the default matches the
+    scaling of Color.hw_export.
+    """
+    SIZE = 4096
+    def __init__(self, gains=(1.0, 0.5, 0.5), gammas=(1.0, 1.0, 1.0)):
+        self.gains = tuple(gains)
+        self.gammas = tuple(gammas)
+        x = numpy.linspace(0.0, 1.0, self.SIZE)
+        self.luts = numpy.array([
+            numpy.clip(numpy.floor(gain * x ** gamma * 0x1F + 0.5), 0, 0x1F)
+            for gain, gamma in zip(self.gains, self.gammas)], dtype=numpy.uint16)
+
+    def export(self, rgba):
+        # N x 4 RGBA -> packed 15-bit little-endian words, 2 bytes per pixel
+        rgba = numpy.asarray(rgba, dtype=float).reshape(-1, 4)
+        values = numpy.clip(rgba[:, :3] * rgba[:, 3:], 0.0, 1.0)
+        idx = (values * (self.SIZE - 1) + 0.5).astype(numpy.intp)
+        r = self.luts[0][idx[:, 0]]
+        g = self.luts[1][idx[:, 1]]
+        b = self.luts[2][idx[:, 2]]
+        words = 0x8000 | (b << 10) | (r << 5) | g
+        # Same special case as Color.hw_export
+        words[words == (0x8000 | 1 << 5)] = 0x8000
+        return bytearray(words.astype("<u2").tobytes())
+
+DEFAULT_CALIBRATION = Calibration()
+
 class LightStrip(gr.Blade):
     sid = gr.Field(0)
     copies = gr.Field(1)
     points = gr.Field([])
 
-    def __init__(self, sid, length=20, copies=1, points=None):
+    def __init__(self, sid, length=20, copies=1, points=None, calibration=None, priority=1.0):
         self.length = length
         self.colors = [Color(r=i / float(self.length), g=0.2, b=0.2) for i in range(self.length)]
         self.sid = sid
         self.copies = copies
         self.points = points 
+        self.calibration = calibration or DEFAULT_CALIBRATION
+        # Relative share of serial bandwidth when a port is over budget
+        self.priority = priority
+
+    @property
+    def colors(self):
+        return self._colors
+
+    @colors.setter
+    def colors(self, colors):
+        # Assigning new colors marks the strip as changed
+        self._colors = colors
+        self.hw_cache = None
 
     @gr.PropertyField
     def html_colors(self):
         return [c.html_rgb for c in self.colors]
 
     def hw_export(self):
-        output = []
-        for color in self.colors:
-            h = color.hw_export()
-            output.append(h & 0xFF)
-            output.append((h >> 8) & 0xFF)
-        return output
+        # Packed bytes for the strip's colors (a list of Colors or a
+        # ColorBuffer); cached until `colors` is assigned again
+        if self.hw_cache is None:
+            colors = self.colors
+            if not isinstance(colors, ColorBuffer):
+                colors = ColorBuffer.from_colors(colors)
+            self.hw_cache = self.calibration.export(colors.rgba)
+        return self.hw_cache
 
     def __repr__(self):
         return "<LightStrip: id={}, len={}>".format(self.sid, len(self))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Offline audio analysis: runs a WAV or raw PCM file through the same
+analysis chain as Beetle.step and writes per-frame features to a .npz file.
+
+    ./offline.py set.wav set_features.npz --hop 512
+"""
+import argparse
+import numpy
+import time
+import wave
+
+import audio
+
+def read_wav(path):
+    # Returns (mono int16 samples, sample rate)
+    w = wave.open(path, "rb")
+    try:
+        if w.getsampwidth() != 2:
+            raise ValueError("Only 16-bit PCM is supported")
+        channels = w.getnchannels()
+        rate = w.getframerate()
+        data = w.readframes(w.getnframes())
+    finally:
+        w.close()
+    samples = numpy.frombuffer(data, dtype="<i2")
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(numpy.int16)
+    return samples, rate
+
+def read_raw(path, channels=1):
+    samples = numpy.fromfile(path, dtype="<i2")
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels]
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(numpy.int16)
+    return samples
+
+def frame_view(samples, chunk, hop):
+    # Overlapping windows as a strided view, one row per frame
+    n_frames = max(0, (len(samples) - chunk) // hop + 1)
+    step = samples.strides[0]
+    return numpy.lib.stride_tricks.as_strided(samples,
+        shape=(n_frames, chunk),
+        strides=(hop * step, step),
+        writeable=False)
+
+class OfflineAnalyzer(object):
+    """
+    Streams samples through an AnalysisChain in batches of `batch` frames.
+
+    FFTs, band energies and hue/chroma are computed for a whole batch at
+    once; only the stateful smoothing runs per frame.
+    """
+    def __init__(self, chain, hop=None, batch=256):
+        self.chain = chain
+        self.hop = hop or chain.chunk
+        self.batch = batch
+
+    def run(self, samples):
+        frames = frame_view(samples, self.chain.chunk, self.hop)
+        n = len(frames)
+        n_bands = len(self.chain.bands)
+        filter_names = list(self.chain.filters.names)
+        out = {
+            "time": (numpy.arange(n) * self.hop + self.chain.chunk) / float(self.chain.rate),
+            "bands": numpy.zeros((n, n_bands)),
+            "lpf_bands": numpy.zeros((n, n_bands)),
+            "levels": numpy.zeros((n, n_bands)),
+            "hue_raw": numpy.zeros(n),
+            "chroma": numpy.zeros((n, 12)),
+        }
+        smoothed = numpy.zeros((n, len(filter_names)))
+
+        for start in range(0, n, self.batch):
+            stop = min(start + self.batch, n)
+            ffts = self.chain.spectrum_batch(frames[start:stop])
+            bands, hues, chromas = self.chain.analyze_batch(ffts)
+            out["bands"][start:stop] = bands
+            out["hue_raw"][start:stop] = hues
+            out["chroma"][start:stop] = chromas
+            for i in range(stop - start):
+                out["levels"][start + i] = self.chain.smooth(bands[i], hues[i])
+                out["lpf_bands"][start + i] = self.chain.lpf_audio
+                smoothed[start + i] = self.chain.filters.state
+
+        for j, name in enumerate(filter_names):
+            out[name] = smoothed[:, j]
+        return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-analyze an audio file with the Beetle analysis chain")
+    parser.add_argument("input", help="16-bit WAV file, or raw little-endian PCM with --raw")
+    parser.add_argument("output", help="Feature file to write (.npz)")
+    parser.add_argument("--raw", action="store_true", help="Input is headerless PCM")
+    parser.add_argument("--rate", type=int, default=audio.AnalysisChain.RATE, help="Sample rate for --raw input")
+    parser.add_argument("--channels", type=int, default=1, help="Channel count for --raw input")
+    parser.add_argument("--chunk", type=int, default=audio.AnalysisChain.CHUNK, help="FFT size")
+    parser.add_argument("--hop", type=int, default=None, help="Samples between frames (default: chunk)")
+    parser.add_argument("--batch", type=int, default=256, help="Frames per batched FFT")
+    args = parser.parse_args()
+
+    if args.raw:
+        samples, rate = read_raw(args.input, args.channels), args.rate
+    else:
+        samples, rate = read_wav(args.input)
+
+    chain = audio.AnalysisChain(chunk=args.chunk, rate=rate)
+    analyzer = OfflineAnalyzer(chain, hop=args.hop, batch=args.batch)
+
+    start_time = time.time()
+    features = analyzer.run(samples)
+    elapsed = time.time() - start_time
+
+    numpy.savez(args.output, **features)
+    duration = len(samples) / float(rate)
+    print("Analyzed {} frames ({:0.1f}s of audio) in {:0.2f}s: {:0.0f}x real time".format(
+        len(features["time"]), duration, elapsed, duration / max(elapsed, 1e-9)))
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,24 @@
 import collections
 import colorsys
 import doitlive
+import functools
+import itertools
+import logging
 import math
+import multiprocessing
+import numbers
+import numpy
+import sys
 
 from grassroots import grassroots as gr
-from lights import Color, rng, Black, yiq_from_phase
+from lights import Color, ColorBuffer, rng, Black, yiq_from_phase, rgb_from_phase
 
-Point = collections.namedtuple("Point", ["x", "y"])
+logger = logging.getLogger(__name__)
+
+# Kept across doitlive reloads, so Points made before one still pickle
+Point = globals().get("Point") or collections.namedtuple("Point", ["x", "y"])
 # Vector is exactly the same, but it's more readable
-Vector = collections.namedtuple("Vector", ["x", "y"])
+Vector = globals().get("Vector") or collections.namedtuple("Vector", ["x", "y"])
 
 def dotp(v1, v2):
     return v1.x * v2.x + v1.y * v2.y
@@ -32,32 +42,110 @@ def points_along(start, end, length):
     sy = start.y
     return [Point(x=sx + dx * i, y=sy + dy * i) for i in range(1, length+1)]
 
-def timer(state, key, rate=1.0, start=False):
-    time = state.get('time', 0.)
-    last_time = state.get('last_time__{}'.format(key), time)
-    offset = state.get('offset__{}'.format(key), 0.)
-
-    time_delta = time - last_time
-    offset += time_delta * float(rate)
-
-    if start:
-        offset = 0.0
+def points_array(points):
+    # List of Points -> N x 2 array
+    return numpy.array(points, dtype=float).reshape(-1, 2)
+
+def strip_positions(points):
+    # Pixel positions along a strip's `points` list, as an N x 2 array
+    positions = []
+    for (start, l), (end, _l) in zip(points, points[1:]):
+        positions += points_along(start, end, l)
+    return points_array(positions)
+
+def color_rgba(color):
+    return numpy.array([color.r, color.g, color.b, color.a], dtype=float)
+
+def blend_onbg(rgba, rgb, alpha):
+    # Array version of Color.mix_onbg: paint `rgb` (one color, or one per
+    # row) with opacity `alpha` (scalar or per row) over `rgba`, in place
+    ColorBuffer(rgba=rgba).mix_onbg(rgb, alpha)
+
+def blend_onbg_where(rgba, mask, rgb, alpha):
+    # blend_onbg restricted to the rows selected by `mask`
+    if mask.any():
+        sub = rgba[mask]
+        blend_onbg(sub, rgb, alpha)
+        rgba[mask] = sub
+
+def render_points_fallback(effect, rgba, points, state):
+    # Apply a per-point effect to every row of `rgba`
+    for i, (x, y) in enumerate(points.tolist()):
+        r, g, b, a = rgba[i]
+        c = effect(Color(r=r, g=g, b=b, a=a), Point(x, y), state)
+        rgba[i] = (c.r, c.g, c.b, c.a)
+
+class Timers(object):
+    """
+    Named timers kept in `Plane.state["timers"]`. Each accumulates `rate`
+    per second of `state["time"]`, and only advances the first time it is
+    read in a frame; later reads that frame return the same offset.
+    """
+    def __init__(self):
+        # key -> [last time, offset]
+        self.timers = {}
+
+    def offset(self, key, time, rate=1.0, start=False):
+        t = self.timers.get(key)
+        if t is None:
+            t = self.timers[key] = [time, 0.]
+        elif t[0] != time:
+            if t[0] is not None:
+                t[1] += (time - t[0]) * rate
+            t[0] = time
+        if start:
+            t[1] = 0.
+        return t[1]
+
+    def reset(self, key, offset=0.):
+        # Restart `key` from `offset`; it keeps advancing from the last frame time
+        t = self.timers.setdefault(key, [None, 0.])
+        t[1] = offset
+
+    def __reduce__(self):
+        # See Color.__reduce__
+        return (_timers_from, (self.timers,))
+
+def _timers_from(timers):
+    t = Timers()
+    t.timers = timers
+    return t
+
+def get_timers(state):
+    timers = state.get("timers")
+    if timers is None:
+        timers = state["timers"] = Timers()
+    return timers
 
-    state['last_time__{}'.format(key)] = time
-    state['offset__{}'.format(key)] = offset
-    
-    return offset
+def timer(state, key, rate=1.0, start=False):
+    return get_timers(state).offset(key, state.get("time", 0.), float(rate), start)
 
 def timeable(key, **kwargs):
     def new_eff(eff_fn):
         def f(c, p, state):
-            time = state.get("time", 0.)
             offset = timer(state, key, **kwargs)
             return eff_fn(c, p, state, offset)
+        # The timer offset is the only input that changes between frames
+        f.frame_key = lambda state: timer(state, key, **kwargs)
         return f
     return new_eff
     
 
+def effect(eff_fn):
+    # Records how an effect was built in `spec`, so that another process
+    # can rebuild it with build_effect()
+    @functools.wraps(eff_fn)
+    def make(*args, **kwargs):
+        d = eff_fn(*args, **kwargs)
+        if d is not None:
+            d.spec = (eff_fn.__name__, args, kwargs)
+        return d
+    return make
+
+def build_effect(spec):
+    name, args, kwargs = spec
+    return globals()[name](*args, **kwargs)
+
 def eff_sine(color, point, rate):
     mc = color.copy()
     alpha = mc.a
@@ -67,13 +155,20 @@ def eff_sine(color, point, rate):
         mc.a = alpha * math.sin(rads)
         return  mc.mix_onbg(c)
 
+@effect
 def eff_diamond(color, point, size):
     def d(c, p, state):
         if abs(p.x - point.x) + abs(p.y - point.y) <= size:
             return color
         return c
+    def render_array(rgba, pts, state):
+        inside = numpy.abs(pts[:, 0] - point.x) + numpy.abs(pts[:, 1] - point.y) <= size
+        rgba[inside] = color_rgba(color)
+    d.render_array = render_array
+    d.bounds = (point.x - size, point.y - size, point.x + size, point.y + size)
     return d
 
+@effect
 def eff_circle(color, point, size, gamma=10):
     mc = color.copy()
     alpha = mc.a
@@ -84,8 +179,19 @@ def eff_circle(color, point, size, gamma=10):
         else:
             mc.a = alpha * math.exp((size - rad) * gamma)
         return mc.mix_onbg(c)
+    rgb = color_rgba(mc)[:3]
+    def render_array(rgba, pts, state):
+        rad = numpy.hypot(pts[:, 0] - point.x, pts[:, 1] - point.y)
+        blend_onbg(rgba, rgb, alpha * numpy.exp(numpy.minimum(size - rad, 0.0) * gamma))
+    d.render_array = render_array
+    d.max_alpha = alpha
+    if gamma > 0 and alpha > NEGLIGIBLE_ALPHA:
+        # Beyond this radius the glow is negligible
+        reach = size + math.log(alpha / NEGLIGIBLE_ALPHA) / gamma
+        d.bounds = (point.x - reach, point.y - reach, point.x + reach, point.y + reach)
     return d
 
+@effect
 def eff_plane(color, point, vector, fade=0.2):
     mc = color.copy()
     alpha = mc.a
@@ -97,13 +203,29 @@ def eff_plane(color, point, vector, fade=0.2):
             return color
         mc.a = abs(dist / fade)
         return mc.mix_onbg(c)
+    rgb = color_rgba(mc)[:3]
+    def render_array(rgba, pts, state):
+        dist = vector.x * (pts[:, 0] - point.x) + vector.y * (pts[:, 1] - point.y)
+        full = (dist > 0) & (numpy.abs(dist) >= abs(fade))
+        part = (dist > 0) & ~full
+        blend_onbg_where(rgba, part, rgb, numpy.abs(dist[part] / fade))
+        rgba[full] = color_rgba(color)
+    d.render_array = render_array
     return d
 
+@effect
 def eff_solid(color):
     def d(c, p, state):
         return color.mix_onbg(c)
+    def render_array(rgba, pts, state):
+        blend_onbg(rgba, color_rgba(color)[:3], color.a)
+    d.render_array = render_array
+    d.max_alpha = color.a
+    d.covers = True
+    d.solid_color = color
     return d
 
+@effect
 def eff_rainbow(vector, rate=5., alpha=1.0, kappa=1.0, y=0.5, key='rainbow'):
     @timeable(key=key, rate=rate)
     def d(c, p, state, offset):
@@ -111,8 +233,16 @@ def eff_rainbow(vector, rate=5., alpha=1.0, kappa=1.0, y=0.5, key='rainbow'):
         mc = yiq_from_phase(y=y, phase=hue, kappa=kappa, a=alpha)
 
         return mc.mix_onbg(c)
+    def render_array(rgba, pts, state):
+        offset = timer(state, key, rate=rate)
+        hue = (offset + pts[:, 0] * vector.x + pts[:, 1] * vector.y) % 1.0
+        blend_onbg(rgba, rgb_from_phase(y=y, phase=hue, kappa=kappa), alpha)
+    d.render_array = render_array
+    d.max_alpha = alpha
+    d.covers = True
     return d
 
+@effect
 def eff_hsv_rainbow(vector, rate=5., alpha=1.0, key='rainbow_hsv'):
     @timeable(key=key, rate=rate)
     def d(c, p, state, offset):
@@ -122,8 +252,16 @@ def eff_hsv_rainbow(vector, rate=5., alpha=1.0, key='rainbow_hsv'):
         mc = yiq_from_phase(y=0.4, phase=hue, kappa=1.9, a=alpha)
 
         return mc.mix_onbg(c)
+    def render_array(rgba, pts, state):
+        offset = timer(state, key, rate=rate)
+        hue = (offset + pts[:, 0] * vector.x + pts[:, 1] * vector.y) % 1.0
+        blend_onbg(rgba, rgb_from_phase(y=0.4, phase=hue, kappa=1.9), alpha)
+    d.render_array = render_array
+    d.max_alpha = alpha
+    d.covers = True
     return d
 
+@effect
 def eff_stripe_time(vector, color, rate=5., gamma=2.5, key='stripe'):
     mc = color.copy()
     alpha = mc.a
@@ -133,8 +271,16 @@ def eff_stripe_time(vector, color, rate=5., gamma=2.5, key='stripe'):
         value = (math.sin(wv) ** 2) ** gamma
         mc.a = alpha * value
         return mc.mix_onbg(c)
+    rgb = color_rgba(mc)[:3]
+    def render_array(rgba, pts, state):
+        offset = timer(state, key, rate=rate)
+        wv = offset + pts[:, 0] * vector.x + pts[:, 1] * vector.y
+        blend_onbg(rgba, rgb, alpha * (numpy.sin(wv) ** 2) ** gamma)
+    d.render_array = render_array
+    d.max_alpha = alpha
     return d
 
+@effect
 def eff_stripe_beat(vector, color, offset, gamma=2.5):
     mc = color.copy()
     alpha = mc.a
@@ -143,12 +289,19 @@ def eff_stripe_beat(vector, color, offset, gamma=2.5):
         value = (math.sin(wv) ** 2) ** gamma
         mc.a = alpha * value
         return mc.mix_onbg(c)
+    rgb = color_rgba(mc)[:3]
+    def render_array(rgba, pts, state):
+        wv = offset + pts[:, 0] * vector.x + pts[:, 1] * vector.y
+        blend_onbg(rgba, rgb, alpha * (numpy.sin(wv) ** 2) ** gamma)
+    d.render_array = render_array
+    d.max_alpha = alpha
     return d
 
+@effect
 def eff_colorout(color, key, rate=0.05):
     mc = color.copy()
     alpha = mc.a
-    def d(c, p, state):
+    def advance(state):
         st = state.get(key, None)
         if st is None:
             st = state[key] = 0
@@ -168,16 +321,217 @@ def eff_colorout(color, key, rate=0.05):
             st = state[key] = 0
 
         state[key + "_last"] = st
-        mc.a = part_complete * alpha
+        return part_complete
+    def d(c, p, state):
+        mc.a = advance(state) * alpha
         return mc.mix_onbg(c)
+    rgb = color_rgba(mc)[:3]
+    def render_array(rgba, pts, state):
+        blend_onbg(rgba, rgb, advance(state) * alpha)
+    d.render_array = render_array
+    d.frame_key = advance
     return d
 
+# Layers more transparent than this are skipped; layers at least this
+# opaque hide whatever is below them (both well under one 5-bit output step)
+NEGLIGIBLE_ALPHA = 1 / 256.0
+OPAQUE_ALPHA = 1.0 - NEGLIGIBLE_ALPHA
+
+def merge_solids(below, above):
+    # One solid color equivalent to painting `above` over `below`
+    a, b = below.a, above.a
+    alpha = 1.0 - (1.0 - a) * (1.0 - b)
+    if alpha <= 0:
+        return Color(r=0, g=0, b=0, a=0)
+    mix = lambda x, y: (y * b + x * a * (1.0 - b)) / alpha
+    return Color(r=mix(below.r, above.r), g=mix(below.g, above.g), b=mix(below.b, above.b), a=alpha)
+
+def optimize_effects(effects):
+    """
+    Simplifies an effect stack without visibly changing what it renders:
+      - drops layers whose `max_alpha` is negligible
+      - drops everything below the topmost opaque layer that `covers`
+        every pixel
+      - merges adjacent `eff_solid` layers into one
+    Effects without this metadata are always kept as they are.
+    """
+    effects = [e for e in effects if getattr(e, "max_alpha", 1.0) > NEGLIGIBLE_ALPHA]
+
+    for i in range(len(effects) - 1, -1, -1):
+        e = effects[i]
+        if getattr(e, "covers", False) and e.max_alpha >= OPAQUE_ALPHA:
+            effects = effects[i:]
+            break
+
+    merged = []
+    for e in effects:
+        solid = getattr(e, "solid_color", None)
+        prev = getattr(merged[-1], "solid_color", None) if merged else None
+        if solid is not None and prev is not None:
+            merged[-1] = eff_solid(merge_solids(prev, solid))
+        else:
+            merged.append(e)
+    return merged
+
+class PixelGrid(object):
+    """
+    Uniform grid over an N x 2 array of pixel positions, for finding the
+    pixels inside a rectangle without testing every one. Pixels are sorted
+    by cell, row by row, so each grid row of a query is one slice.
+    """
+    def __init__(self, points, per_cell=4):
+        self.n = len(points)
+        if not self.n:
+            return
+        self.lo = points.min(axis=0)
+        extent = numpy.maximum(points.max(axis=0) - self.lo, 1e-9)
+        # Roughly square cells holding `per_cell` pixels on average
+        cell = max(math.sqrt(extent[0] * extent[1] * per_cell / float(self.n)),
+                   extent.max() * per_cell / float(self.n))
+        self.cell = cell
+        self.shape = numpy.minimum((extent // cell).astype(int) + 1, self.n)
+        cells = self.cells(points)
+        self.order = numpy.argsort(cells, kind="mergesort")
+        self.starts = numpy.searchsorted(cells[self.order], numpy.arange(self.shape[0] * self.shape[1] + 1))
+
+    def cells(self, points):
+        ij = numpy.clip(((points - self.lo) // self.cell).astype(int), 0, self.shape - 1)
+        return ij[:, 1] * self.shape[0] + ij[:, 0]
+
+    def query(self, points, bounds):
+        # Sorted indices of the rows of `points` inside
+        # bounds = (xmin, ymin, xmax, ymax)
+        if not self.n:
+            return numpy.zeros(0, dtype=numpy.intp)
+        x0, y0, x1, y1 = bounds
+        (i0, j0), (i1, j1) = [
+            numpy.clip(((numpy.array(p) - self.lo) // self.cell).astype(int), 0, self.shape - 1)
+            for p in ((x0, y0), (x1, y1))]
+        if x1 < self.lo[0] or y1 < self.lo[1]:
+            return numpy.zeros(0, dtype=numpy.intp)
+        rows = [self.order[self.starts[j * self.shape[0] + i0]:self.starts[j * self.shape[0] + i1 + 1]]
+                for j in range(j0, j1 + 1)]
+        idx = numpy.concatenate(rows)
+        pts = points[idx]
+        inside = (pts[:, 0] >= x0) & (pts[:, 0] <= x1) & (pts[:, 1] >= y0) & (pts[:, 1] <= y1)
+        return numpy.sort(idx[inside])
+
+def render_effects(effects, points, state, background, optimize=True, index=None):
+    # Renders an N x 2 array of points at once; returns N x 4 RGBA.
+    # Effects without a `render_array` fall back to per-point calls.
+    # With a PixelGrid `index` for `points`, effects that declare `bounds`
+    # only render the pixels inside them.
+    rgba = numpy.empty((len(points), 4))
+    rgba[:] = color_rgba(background)
+    if optimize:
+        effects = optimize_effects(effects)
+    for effect in effects:
+        render = getattr(effect, "render_array", None)
+        if render is None:
+            render_points_fallback(effect, rgba, points, state)
+            continue
+        bounds = getattr(effect, "bounds", None)
+        if index is None or bounds is None:
+            render(rgba, points, state)
+            continue
+        idx = index.query(points, bounds)
+        if len(idx) == len(points):
+            render(rgba, points, state)
+        elif len(idx):
+            sub = rgba[idx]
+            render(sub, points[idx], state)
+            rgba[idx] = sub
+    return rgba
+
+def plain_value(value):
+    # A comparable copy of an effect argument made of numbers, strings and
+    # tuples only, so it doesn't depend on any class (doitlive replaces the
+    # classes when it reloads a module). Raises TypeError for anything else.
+    if value is None or isinstance(value, (numbers.Number, str, type(u""))):
+        return value
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return plain_value(value.tolist())
+    if isinstance(value, (tuple, list)):
+        return tuple(plain_value(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, plain_value(v)) for k, v in value.items()))
+    if type(value).__name__ == "Color":
+        # Also matches Colors made before lights was reloaded
+        return ("Color", value.r, value.g, value.b, value.a)
+    raise TypeError("Can't describe {!r} with plain values".format(value))
+
+def overlaps(a, b):
+    # Whether two (xmin, ymin, xmax, ymax) rectangles intersect
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+_geometry_versions = itertools.count(1)
+
+class StripGeometry(object):
+    """
+    Pixel positions for a group of strips, packed into one contiguous
+    N x 2 array, with a PixelGrid index over them and each strip's bounding
+    box. Rebuilt only when some strip's `points` change; `version` changes
+    with every rebuild.
+    """
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.key = None
+        self.version = next(_geometry_versions)
+        self.positions = numpy.zeros((0, 2))
+        self.index = PixelGrid(self.positions)
+        self.slices = []
+        self.bounds = []
+        # Plane.frame_signature() of the last render into each strip
+        self.signatures = []
+
+    def update(self, strips):
+        key = [None if strip.points is None else list(strip.points) for strip in strips]
+        if key == self.key:
+            return self
+        positions = []
+        self.slices = []
+        self.bounds = []
+        start = 0
+        for points in key:
+            if points is None:
+                self.slices.append(None)
+                self.bounds.append(None)
+                continue
+            pos = strip_positions(points)
+            positions.append(pos)
+            self.slices.append(slice(start, start + len(pos)))
+            self.bounds.append(tuple(pos.min(axis=0)) + tuple(pos.max(axis=0)) if len(pos) else None)
+            start += len(pos)
+        self.positions = numpy.concatenate(positions) if positions else numpy.zeros((0, 2))
+        self.index = PixelGrid(self.positions)
+        self.version = next(_geometry_versions)
+        self.key = key
+        self.signatures = [None] * len(key)
+        return self
+
 class Plane(gr.Blade):
     def __init__(self):
         # Effect :: (Color -> Point -> Color)
         self.effects = []
         self.background_color = Color(r=0, g=0, b=0, a=0)
         self.state = {}
+        # (strip ids) -> StripGeometry
+        self.geometry = {}
+        # Simplify the effect stack before rendering arrays
+        self.optimize = True
+        # Don't re-render strips when the frame can't have changed
+        self.skip_unchanged = True
+
+    def invalidate_geometry(self):
+        self.geometry = {}
+
+    @property
+    def timers(self):
+        return get_timers(self.state)
 
     def render(self, start, end, length):
         # Renders the stack of layers along the line from `start` to `end`
@@ -188,13 +542,185 @@ class Plane(gr.Blade):
         # Renders a single point by applying effects stack
         return reduce(lambda color, fn: fn(color, point, self.state), self.effects, self.background_color)
 
-    def render_strip(self, strip):
-        s = strip.points
-        if s is not None:
-            pairs = zip(s, s[1:])
-            colors = []
-            for (start, l), (end, _l) in pairs:
-                colors += self.render(start, end, l)
-            strip.colors = colors
-
+    def render_array(self, points, index=None):
+        return render_effects(self.effects, points, self.state, self.background_color, self.optimize, index)
+
+    def strip_geometry(self, strips):
+        key = tuple(id(strip) for strip in strips)
+        if key not in self.geometry:
+            self.geometry[key] = StripGeometry()
+        return self.geometry[key].update(strips)
+
+    def frame_keys(self):
+        # (bounds, key) for each effect that will actually be rendered this
+        # frame, or None if some effect has no spec
+        effects = optimize_effects(self.effects) if self.optimize else self.effects
+        keys = []
+        for effect in effects:
+            spec = getattr(effect, "spec", None)
+            if spec is None:
+                return None
+            frame_key = getattr(effect, "frame_key", None)
+            try:
+                key = plain_value((spec, frame_key(self.state) if frame_key else None))
+            except TypeError:
+                return None
+            keys.append((getattr(effect, "bounds", None), key))
+        return keys
+
+    def frame_signature(self, bounds=None, keys=None):
+        """
+        Everything the rendered output depends on this frame, as plain
+        values: the spec of each effect left after optimization, plus its
+        `frame_key(state)` (e.g. timer offset) if it has one. With `bounds`,
+        effects whose own bounds miss that rectangle are left out.
+        Returns None if some effect can't be described this way.
+        """
+        if keys is None:
+            keys = self.frame_keys()
+        if keys is None:
+            return None
+        return (tuple(key for b, key in keys if bounds is None or b is None or overlaps(b, bounds)),
+                plain_value(self.background_color), self.optimize)
+
+    def changed_strips(self, geometry):
+        # Indices of the strips in `geometry` that don't already show this frame
+        live = [i for i, sl in enumerate(geometry.slices) if sl is not None]
+        if not self.skip_unchanged:
+            return live
+        keys = self.frame_keys()
+        changed = []
+        for i in live:
+            signature = None if keys is None else self.frame_signature(geometry.bounds[i], keys)
+            if signature is None or signature != geometry.signatures[i]:
+                geometry.signatures[i] = signature
+                changed.append(i)
+        return changed
+
+    def render_strips(self, strips):
+        # Renders every pixel of every strip in one pass over the effects,
+        # or just the strips whose signature changed
+        geometry = self.strip_geometry(strips)
+        changed = self.changed_strips(geometry)
+        if len(changed) < sum(sl is not None for sl in geometry.slices):
+            for i in changed:
+                strips[i].colors = ColorBuffer(rgba=self.render_array(geometry.positions[geometry.slices[i]]))
+        elif changed:
+            self.export_strips(strips, geometry, self.render_array(geometry.positions, geometry.index))
+
+    def export_strips(self, strips, geometry, rgba):
+        for strip, sl in zip(strips, geometry.slices):
+            if sl is not None:
+                strip.colors = ColorBuffer(rgba=rgba[sl].copy())
 
+    def render_strip(self, strip):
+        self.render_strips([strip])
+
+
+
+def _render_worker(conn, positions, output):
+    # Runs in a ParallelRenderer process: renders pixel ranges of the shared
+    # position buffer into the shared output buffer, one message per frame
+    positions = numpy.frombuffer(positions).reshape(-1, 2)
+    output = numpy.frombuffer(output).reshape(-1, 4)
+    index_key, index = None, None
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        if msg == "reload":
+            # See ParallelRenderer.reload; this loop keeps running, but
+            # everything it calls is looked up in the reloaded module
+            try:
+                reload(sys.modules["lights"])
+                reload(sys.modules[__name__])
+                index_key, index = None, None
+                conn.send(None)
+            except Exception as e:
+                conn.send(e)
+            continue
+        specs, state, background, optimize, version, start, stop, return_state = msg
+        try:
+            effects = [build_effect(spec) for spec in specs]
+            if index_key != (version, start, stop):
+                # Index this worker's share of the pixels once per geometry
+                index_key, index = (version, start, stop), PixelGrid(positions[start:stop].copy())
+            output[start:stop] = render_effects(effects, positions[start:stop], state, background, optimize, index)
+            conn.send(state if return_state else None)
+        except Exception as e:
+            conn.send(e)
+
+class ParallelRenderer(object):
+    """
+    Renders a Plane's strips across a pool of worker processes.
+
+    Each frame the effect specs and a snapshot of `Plane.state` are sent to
+    every worker once; each renders its share of the pixels into a shared
+    RGBA buffer. The first worker's updated state (timers etc.) is copied
+    back to the plane. Frames with fewer than `min_pixels` or more than
+    `max_pixels` pixels (the size of the shared buffers), or with effects
+    that can't be rebuilt from a spec, render in-process instead.
+    """
+    def __init__(self, workers=None, max_pixels=16384, min_pixels=2000):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_pixels = max_pixels
+        self.min_pixels = min_pixels
+        # Pixel count we last warned doesn't fit
+        self.oversize = None
+        self.shared_positions = multiprocessing.RawArray("d", max_pixels * 2)
+        self.shared_output = multiprocessing.RawArray("d", max_pixels * 4)
+        self.positions = numpy.frombuffer(self.shared_positions).reshape(-1, 2)
+        self.output = numpy.frombuffer(self.shared_output).reshape(-1, 4)
+        self.conns = []
+        self.procs = []
+        for i in range(self.workers):
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_render_worker,
+                args=(child, self.shared_positions, self.shared_output))
+            proc.daemon = True
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for proc in self.procs:
+            proc.join(1.0)
+        self.conns = []
+        self.procs = []
+
+    def reload(self):
+        # Re-import lights and projection in every worker, e.g. after a
+        # doitlive refresh; unlike starting new workers this doesn't fork
+        for conn in self.conns:
+            conn.send("reload")
+        for conn in self.conns:
+            result = conn.recv()
+            if isinstance(result, Exception):
+                raise result
+
+    def render_strips(self, plane, strips):
+        geometry = plane.strip_geometry(strips)
+        n = len(geometry.positions)
+        specs = [getattr(e, "spec", None) for e in plane.effects]
+        if n > self.max_pixels and self.oversize != n:
+            self.oversize = n
+            logger.warning("%d pixels don't fit the %d-pixel render buffers; rendering in-process",
+                           n, self.max_pixels)
+        if not self.conns or n < self.min_pixels or n > self.max_pixels or None in specs:
+            return plane.render_strips(strips)
+        if not plane.changed_strips(geometry):
+            return
+
+        self.positions[:n] = geometry.positions
+        bounds = numpy.linspace(0, n, len(self.conns) + 1).astype(int)
+        for i, conn in enumerate(self.conns):
+            conn.send((specs, plane.state, plane.background_color, plane.optimize,
+                       geometry.version, bounds[i], bounds[i + 1], i == 0))
+        results = [conn.recv() for conn in self.conns]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        plane.state.update(results[0])
+        plane.export_strips(strips, geometry, self.output[:n])
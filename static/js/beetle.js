@@ -47,7 +47,23 @@
         });
 
         ui.on("change:spectrum", function(model, value){
-            $(".spectrum").text(value);
+            var canvas = $("canvas.spectrum")[0];
+            var ctx = canvas.getContext("2d");
+            var freqs = ui.get("spectrum_freqs");
+            var w = canvas.width / Math.max(value.length, 1);
+            ctx.clearRect(0, 0, canvas.width, canvas.height);
+            ctx.fillStyle = "#336633";
+            _.each(value, function(v, i){
+                ctx.fillRect(i * w, canvas.height * (1 - v), w - 1, canvas.height * v);
+            });
+            ctx.fillStyle = "#000000";
+            for(var i = 0; i < freqs.length; i += 8){
+                ctx.fillText(freqs[i], i * w, 10);
+            }
+        });
+
+        ui.on("change:spectrum_peak", function(model, value){
+            $(".spectrum-peak").text("max @: " + value + " Hz");
         });
 
         ui.on("change:graph_data", function(model, value){
@@ -0,0 +1,113 @@
+import collections
+import math
+import time
+
+class LatencyMeter(object):
+    """
+    Running statistics of a duration: the last value, an exponential
+    moving average and the maximum over the last `window` values.
+    """
+    def __init__(self, alpha=0.1, window=100):
+        self.alpha = alpha
+        self.recent = collections.deque(maxlen=window)
+        self.last = 0.0
+        self.avg = None
+
+    def update(self, value):
+        self.last = value
+        if self.avg is None:
+            self.avg = value
+        else:
+            self.avg += self.alpha * (value - self.avg)
+        self.recent.append(value)
+        return value
+
+    @property
+    def max(self):
+        return max(self.recent) if self.recent else 0.0
+
+    def estimate(self):
+        return self.avg or 0.0
+
+class FrameScheduler(object):
+    """
+    Paces output frames at `rate` frames/sec, and predicts when each frame
+    will actually leave the serial port so effects can be rendered for that
+    moment instead of for when the audio was captured.
+
+        t = scheduler.begin()  # once the frame's audio is in; render for time t
+        scheduler.wait()       # after rendering: sleep until the frame's slot
+        scheduler.done()       # after the frame has been handed to the devices
+        scheduler.flushed(t, handoff, flush_time)  # when a device reports it out
+
+    With `rate` 0 frames go out as soon as they are rendered. If a frame
+    can't be ready for the next slot, slots are skipped (counted in
+    `missed`) rather than bunching frames together.
+    """
+    def __init__(self, rate=0, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        # begin() -> wait(), wait() -> done(), and handoff -> flushed
+        self.work = LatencyMeter()
+        self.export = LatencyMeter()
+        self.flush = LatencyMeter()
+        # Actual minus predicted output time
+        self.error = LatencyMeter()
+        # Between successive begin() calls
+        self.interval = LatencyMeter()
+        self.missed = 0
+        self.begin_time = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.period = 1.0 / rate if rate else 0.0
+        self.next_slot = None
+        self.slot = None
+        self.output_time = None
+
+    def begin(self):
+        now = self.clock()
+        if self.begin_time is not None:
+            self.interval.update(now - self.begin_time)
+        self.begin_time = now
+        ready = self.begin_time + self.work.estimate()
+        if self.period:
+            if self.next_slot is None:
+                self.next_slot = ready
+            elif self.next_slot < ready:
+                skip = int(math.ceil((ready - self.next_slot) / self.period))
+                self.missed += skip
+                self.next_slot += skip * self.period
+            self.slot = self.next_slot
+            self.next_slot += self.period
+        else:
+            self.slot = ready
+        self.output_time = self.slot + self.export.estimate() + self.flush.estimate()
+        return self.output_time
+
+    def frame_rate(self):
+        # Target rate, or the measured one when unpaced
+        if self.rate:
+            return self.rate
+        interval = self.interval.estimate()
+        return 1.0 / interval if interval > 0 else None
+
+    def wait(self):
+        now = self.clock()
+        self.work.update(now - self.begin_time)
+        if self.period and self.slot > now:
+            self.sleep(self.slot - now)
+        self.export_start = self.clock()
+
+    def done(self):
+        # Returns the time the frame was handed off
+        now = self.clock()
+        self.export.update(now - self.export_start)
+        return now
+
+    def flushed(self, predicted, handoff, flush_time):
+        # A frame predicted to go out at `predicted`, handed off at
+        # `handoff`, was actually flushed at `flush_time`
+        self.flush.update(flush_time - handoff)
+        self.error.update(flush_time - predicted)
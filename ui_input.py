@@ -42,6 +42,10 @@ class NKController(NanoKontrol2, doitlive.SafeRefreshMixin):
         3: 6,
     }
 
+    # Holding a bank's SYNC this many seconds hands its tempo back to the
+    # beat tracker
+    LONG_PRESS = 1.0
+
     def __init__(self):
         NanoKontrol2.__init__(self)
         doitlive.SafeRefreshMixin.__init__(self)
@@ -73,9 +77,18 @@ class NKController(NanoKontrol2, doitlive.SafeRefreshMixin):
             "bpm": 120,
             "deltas": [], 
             "last_event": 0.0,
-            "alpha": 0.1
+            "alpha": 0.1,
+            # Follow set_bank_tempo(); off after a manual tap or tempo change,
+            # back on after a long press of SYNC
+            "auto": True,
         }
 
+    def set_bank_auto(self, bank, enabled=True, key=Map.SYNC):
+        # Re-enable (or disable) automatic tempo for a bank
+        offset = self.OFFSETS[bank] + key
+        if offset in self.beat_state:
+            self.beat_state[offset]["auto"] = enabled
+
     def set_bank_bpm(self, bank, bpm=140.0, key=Map.SYNC):
         offset = self.OFFSETS[bank] + key
         if offset in self.beat_state:
@@ -84,10 +97,36 @@ class NKController(NanoKontrol2, doitlive.SafeRefreshMixin):
             data["tau"] = 60. / bpm
             data["bpm"] = bpm
             data["deltas"] = [data["tau"]] * 3 # preload
+            data["auto"] = False
             new_phase = ((time.time() + data["phi"]) % data["tau"]) / data["tau"]
             data["phi"] -= (new_phase - old_phase) * data["tau"]
             print "BPM Set: phi={:0.2f}; bpm={:0.1f}".format(new_phase, bpm)
 
+    def set_bank_tempo(self, bank, bpm, beat_time, key=Map.SYNC, alpha=0.2):
+        # Automatic tempo: nudge the beat clock towards `bpm` with a beat at
+        # `beat_time`. Does nothing once the bank's tempo was set by hand.
+        offset = self.OFFSETS[bank] + key
+        if offset not in self.beat_state:
+            return False
+        data = self.beat_state[offset]
+        if not data["auto"]:
+            return False
+        # Keep the current phase continuous across the tempo change
+        now = time.time()
+        old_phase = (now + data["phi"]) / data["tau"]
+        data["tau"] += alpha * (60. / bpm - data["tau"])
+        data["bpm"] = 60. / data["tau"]
+        new_phase = (now + data["phi"]) / data["tau"]
+        data["phi"] -= (new_phase - old_phase) * data["tau"]
+        data["deltas"] = [data["tau"]] * 3 # preload
+        phase = ((beat_time + data["phi"]) % data["tau"]) / data["tau"]
+        if phase > 0.5:
+            error = (phase - 1.0) * data["tau"]
+        else:
+            error = phase * data["tau"]
+        data["phi"] -= error * alpha
+        return True
+
     def bank_bpm(self, bank, bpm=None, key=Map.SYNC):
         if bpm is not None:
             return self.set_bank_bpm(bank, bpm)
@@ -98,13 +137,16 @@ class NKController(NanoKontrol2, doitlive.SafeRefreshMixin):
         return 140
 
 
-    def bank_beat(self, bank, key=Map.SYNC, cont=False):
+    def bank_beat(self, bank, key=Map.SYNC, cont=False, at=None):
+        # Beat phase at time `at` (default: now)
         offset = self.OFFSETS[bank] + key
         data = self.beat_state[offset]
+        if at is None:
+            at = time.time()
         if cont:
-            return ((time.time() + data["phi"]) / data["tau"])
+            return ((at + data["phi"]) / data["tau"])
         else:
-            return ((time.time() + data["phi"]) % data["tau"]) / data["tau"]
+            return ((at + data["phi"]) % data["tau"]) / data["tau"]
 
     def update(self):
         self.process_input()
@@ -113,9 +155,13 @@ class NKController(NanoKontrol2, doitlive.SafeRefreshMixin):
             events = self.events.get(key, [])
             for timestamp, evtype in events:
                 if not evtype:
-                    continue  # Only keydown events
+                    if timestamp - data["last_event"] >= self.LONG_PRESS:
+                        data["auto"] = True
+                        print "Auto tempo on"
+                    continue  # Otherwise only keydown events
                 delta = timestamp - data["last_event"]
                 data["last_event"] = timestamp
+                data["auto"] = False
                 if 0.1 < delta < 2.0:
                     data["deltas"] = ([delta] + data["deltas"])[:5]
                     deltas = data["deltas"]
@@ -140,6 +186,8 @@ class NKController(NanoKontrol2, doitlive.SafeRefreshMixin):
             if self.edge_state[NKMap.SET]:
                 for key, _dat in self.beat_state.items():
                     self.beat_state[key] = data.copy()
+            if self.edge_state[NKMap.SLEFT] or self.edge_state[NKMap.SRIGHT]:
+                data["auto"] = False
             if self.edge_state[NKMap.SLEFT]:
                 old_phase = ((time.time() + data["phi"]) ) / data["tau"]
                 data["tau"] *= 2